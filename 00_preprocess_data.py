@@ -1,8 +1,59 @@
 import numpy as np
 import pandas as pd
 import os
-from scipy.signal import savgol_filter
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import functools
+import concurrent.futures
+from scipy.signal import savgol_coeffs
+from scipy.ndimage import convolve1d
 import ast
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import trajectory_store
+
+# columns of the raw logs as written by data_collection/CarlaClientTruck.py, with compact types: small integers for the
+# ids and flags, float32 for the kinematics (logged with 4 decimals), categoricals for the few acceleration profiles,
+# and float64 for the time and the conditions, which are compared with the conditions of the models
+RAW_COLUMNS = ["subj_id", "session", "route", "intersection_no",
+               "intersection_x", "intersection_y", "turn_direction", "t",
+               "ego_distance_to_intersection", "tta_condition", "d_condition", "v_condition",
+               "truck_angle", "bot_angle", "accl_profile_values", "accl_profile_times",
+               "ego_x", "ego_y", "ego_vx", "ego_vy", "ego_ax", "ego_ay", "ego_yaw",
+               "bot_x", "bot_y", "bot_vx", "bot_vy", "bot_ax", "bot_ay", "bot_yaw",
+               "throttle", "brake", "steer", "let_pass", "subjective_good", "subjective_bad",
+               "truck_x", "truck_y", "truck_vx", "truck_vy", "truck_ax", "truck_ay", "truck_yaw"]
+RAW_DTYPES = dict({column: "float32" for column in RAW_COLUMNS},
+                  subj_id="int16", session="int8", route="int8", intersection_no="int16", intersection_x="int32",
+                  intersection_y="int32", turn_direction="int8", t="float64",
+                  tta_condition="float64", d_condition="float64", v_condition="float64",
+                  accl_profile_values="category", accl_profile_times="category",
+                  let_pass="int8", subjective_good="int8", subjective_bad="int8")
+RAW_SCHEMA = pa.schema([(column, pa.dictionary(pa.int32(), pa.string()) if dtype == "category"
+                         else pa.from_numpy_dtype(np.dtype(dtype))) for column, dtype in RAW_DTYPES.items()])
+RAW_INDEX = ["subj_id", "session", "route", "intersection_no"]
+# the raw dataset has a directory per subject and session, e.g. data/raw_dataset/subj_id=5/session=1
+RAW_PARTITIONING = ds.partitioning(pa.schema([RAW_SCHEMA.field("subj_id"), RAW_SCHEMA.field("session")]),
+                                   flavor="hive")
+
+# columns of the raw data used by process_data
+PROCESS_COLUMNS = ["turn_direction", "t", "ego_distance_to_intersection", "tta_condition", "d_condition",
+                   "truck_angle", "bot_angle", "accl_profile_values",
+                   "ego_x", "ego_y", "ego_vx", "ego_vy", "ego_ax", "ego_ay",
+                   "bot_x", "bot_y", "bot_vx", "bot_vy", "bot_ax", "bot_ay",
+                   "throttle", "let_pass", "subjective_bad", "truck_x", "truck_y", "truck_vx", "truck_vy"]
+# the other raw columns, which are not processed, but added to the processed data of the rows that process_data keeps
+OTHER_COLUMNS = [column for column in RAW_COLUMNS if column not in RAW_INDEX + PROCESS_COLUMNS]
+# columns of the raw data renamed by process_data
+PROCESS_RENAMES = {"tta_condition": "tta_0", "d_condition": "d_0", "accl_profile_values": "a_values"}
+# kinematics smoothed by process_data
+SMOOTHED_COLUMNS = ["ego_x", "ego_y", "ego_vx", "ego_vy", "ego_ax", "ego_ay",
+                    "bot_x", "bot_y", "bot_vx", "bot_vy", "bot_ax", "bot_ay"]
 
 
 def merge_csv_files(data_path):
@@ -17,6 +68,48 @@ def merge_csv_files(data_path):
     df_concat.to_csv(os.path.join(data_path, "raw_data_merged.csv"), index=False, sep="\t")
 
 
+def convert_raw_logs(files, dataset_path, chunksize=100000):
+    """ Converts raw logs (the individual files in data/raw, or the merged file) to a Parquet dataset partitioned by
+    subj_id and session. Each file is read chunksize rows at a time, so memory use does not grow with its size """
+    # the partition columns are not stored in the files
+    file_schema = pa.schema([field for field in RAW_SCHEMA if field.name not in RAW_PARTITIONING.schema.names])
+    for file_path in sorted(files):
+        print(file_path)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        # remove the parts written by an earlier conversion of this file
+        for part in glob.glob(os.path.join(dataset_path, "*", "*", name + "-*.parquet")):
+            os.remove(part)
+        for i, chunk in enumerate(pd.read_csv(file_path, sep="\t", dtype=RAW_DTYPES, chunksize=chunksize)):
+            # the partitions are written as files in hive directories (not with ds.write_dataset, which can abort the
+            # interpreter at exit with pyarrow 15), and the parts of a file are named in the order of its rows
+            for (subj_id, session), part in chunk.groupby(["subj_id", "session"]):
+                part_path = os.path.join(dataset_path, "subj_id=%i" % subj_id, "session=%i" % session)
+                os.makedirs(part_path, exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(part.drop(columns=["subj_id", "session"]), schema=file_schema,
+                                                    preserve_index=False),
+                               os.path.join(part_path, "%s-%05i.parquet" % (name, i)))
+
+
+def read_raw_data(dataset_path, columns=None, subj_ids=None, sessions=None):
+    """ Raw data indexed by RAW_INDEX, as in raw_data_merged.csv. Only the given columns (all if None) are read, and
+    only the partitions of subj_ids and sessions (all if None) """
+    dataset = ds.dataset(dataset_path, schema=RAW_SCHEMA, format="parquet", partitioning=RAW_PARTITIONING)
+    selection = None
+    for column, values in [("subj_id", subj_ids), ("session", sessions)]:
+        if values is not None:
+            expression = ds.field(column).isin(list(values))
+            selection = expression if selection is None else selection & expression
+    if columns is not None:
+        columns = RAW_INDEX + [column for column in columns if column not in RAW_INDEX]
+    # the sort is stable, so it keeps the samples of each trial in the order they were logged; it is done before the
+    # conversion to pandas, which then frees each column of the table once it is converted
+    table = dataset.to_table(columns=columns, filter=selection).sort_by([(column, "ascending") for column in RAW_INDEX])
+    raw_data = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    raw_data.set_index(RAW_INDEX, inplace=True)
+    return raw_data
+
+
 def get_measures(traj):
     # print(traj.name)
     if (sum(traj.bot_v) > 0) & (sum(traj.throttle) > 0):
@@ -58,59 +151,181 @@ def get_measures(traj):
                       "RT_yield": RT_yield,
                       "is_negative_rating": is_negative_rating})
 
-def process_data(data):
-    data.loc[:,"t"] = data.t.groupby(data.index.names).transform(lambda t: (t-t.min()))
-
-    data = data.rename(columns={"tta_condition": "tta_0", "d_condition": "d_0", "accl_profile_values": "a_values"})
-
-    # we are only interested in left turns
-    data = data[data.turn_direction==1]
-
-    # discarding the filler trials
-    data = data[data.d_0==80]
-
-    # only consider the data recorded within 20 meters of each intersection
-    data = data[abs(data.ego_distance_to_intersection)<20]
-
-    # smooth the time series by filtering out the noise using Savitzky-Golay filter
-    apply_filter = lambda traj: savgol_filter(traj, window_length=21, polyorder=2, axis=0)
-    cols_to_smooth = ["ego_x", "ego_y", "ego_vx", "ego_vy", "ego_ax", "ego_ay",
-                      "bot_x", "bot_y", "bot_vx", "bot_vy", "bot_ax", "bot_ay"]
-    data.loc[:, cols_to_smooth] = (data.loc[:, cols_to_smooth].groupby(data.index.names).transform(apply_filter))
+def get_trials(index):
+    """ Order of the rows that sorts them by trial (keeping the order of the samples within each trial), the start and
+    length of each trial in that order, and the trial index values, sorted as by groupby """
+    codes, trials = index.factorize(sort=True)
+    order = np.argsort(codes, kind="stable")
+    lengths = np.bincount(codes, minlength=len(trials))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return order, starts, lengths, trials.set_names(index.names)
+
+
+def get_first(mask, starts, positions):
+    # position within its trial of the first True value of mask in each trial, -1 if there is none
+    first = np.minimum.reduceat(np.where(mask, positions, len(mask)), starts)
+    return np.where(first < len(mask), first, -1)
+
+
+def get_trial_measures(data):
+    """ Same as data.groupby(data.index.names).apply(get_measures), computed for all trials at once """
+    order, starts, lengths, trials = get_trials(data.index)
+    columns = {column: data[column].to_numpy(dtype=float)[order]
+               for column in ["t", "bot_v", "throttle", "d_ego_bot", "let_pass", "subjective_bad", "ego_x", "ego_y",
+                              "truck_x", "truck_y"]}
+    # position of each sample within its trial
+    positions = np.arange(len(order)) - np.repeat(starts, lengths)
+
+    def get_t(idx):
+        # t at position idx of each trial, where -1 is the last sample as in traj.t.values[idx]
+        return columns["t"][starts + idx % lengths]
+
+    is_responded = ((np.add.reduceat(columns["bot_v"], starts) > 0)
+                    & (np.add.reduceat(columns["throttle"], starts) > 0))
+    idx_bot_visible = np.where(is_responded, get_first(columns["bot_v"] != 0, starts, positions), -1)
+    # the samples from idx_bot_visible on, which is the last sample only if it is -1, as in traj.iloc[-1:]
+    is_visible = positions >= np.repeat(idx_bot_visible % lengths, lengths)
+    idx_gas_response = np.where(is_responded,
+                                get_first(is_visible & (columns["throttle"] > 0), starts, positions), -1)
+    RT_gas = np.where(is_responded, get_t(idx_gas_response) - get_t(idx_bot_visible), -1.)
+    distance = np.where(is_visible, columns["d_ego_bot"], np.inf)
+    min_distance = np.minimum.reduceat(distance, starts)
+    idx_min_distance = np.where(is_responded,
+                                get_first(distance == np.repeat(min_distance, lengths), starts, positions), -1)
+    min_distance = np.where(is_responded, min_distance, -1.)
+
+    gap_to_truck = np.fmin.reduceat(np.sqrt((columns["ego_x"] - columns["truck_x"])**2
+                                            + (columns["ego_y"] - columns["truck_y"])**2), starts)
+
+    is_yielded = np.add.reduceat(np.where(is_visible, columns["let_pass"], 0), starts) > 0
+    idx_yield = np.where(is_yielded, idx_bot_visible + get_first(is_visible & (columns["let_pass"] > 0), starts,
+                                                                 positions) - idx_bot_visible % lengths, -1)
+    RT_yield = np.where(is_yielded, get_t(idx_yield) - get_t(idx_bot_visible), -1.)
+
+    is_negative_rating = np.logical_or.reduceat(columns["subjective_bad"] != 0, starts)
+    return pd.DataFrame({"idx_bot_visible": idx_bot_visible,
+                         "idx_response": idx_gas_response,
+                         "idx_yield": idx_yield,
+                         "idx_min_distance": idx_min_distance,
+                         "min_distance": min_distance,
+                         "gap_to_truck": gap_to_truck,
+                         "RT_gas": RT_gas,
+                         "RT_yield": RT_yield,
+                         "is_negative_rating": is_negative_rating}, index=trials)
+
+
+def smooth_trials(values, starts, lengths, window_length=21, polyorder=2):
+    """ savgol_filter(trial, window_length, polyorder, axis=0) of each trial in values (a 2-D array of samples sorted by
+    trial, with the given trial starts and lengths), for all trials in one pass """
+    if lengths.min() < window_length:
+        raise ValueError("All trials need at least window_length=%i samples" % window_length)
+    # the convolution is the one savgol_filter applies to each trial; it mixes samples of neighbouring trials only in
+    # the window_length // 2 samples at either end of a trial, which are replaced by polynomial fits below
+    smoothed = convolve1d(values, savgol_coeffs(window_length, polyorder), axis=0, mode="constant")
+    # savgol_filter fits a polynomial to the first and the last window of a trial, to interpolate the samples at the
+    # edges; the windows of all trials and columns are fitted at once
+    half_length = window_length // 2
+    window = np.arange(window_length)
+    for window_starts, edge in [(starts, window[:half_length]),
+                                (starts + lengths - window_length, window[window_length - half_length:])]:
+        windows = values[window_starts[:, None] + window].transpose(1, 0, 2)
+        coefficients = np.polyfit(window, windows.reshape(window_length, -1), polyorder)
+        fitted = np.polyval(coefficients, edge.reshape(-1, 1)).reshape(len(edge), len(starts), -1)
+        smoothed[window_starts[:, None] + edge] = fitted.transpose(1, 0, 2)
+    return smoothed
+
+
+def get_kinematics(data):
+    """ The SMOOTHED_COLUMNS of data smoothed per trial, and the speeds, accelerations, distances and angles derived
+    from them, as arrays in the row order of data """
+    order, starts, lengths, trials = get_trials(data.index)
+    smoothed = np.empty((len(data), len(SMOOTHED_COLUMNS)))
+    smoothed[order] = smooth_trials(data[SMOOTHED_COLUMNS].to_numpy(dtype=float)[order], starts, lengths)
+    kinematics = dict(zip(SMOOTHED_COLUMNS, smoothed.T))
 
     # calculate absolute values of speed and acceleration
-    data["ego_v"] = np.sqrt(data.ego_vx**2 + data.ego_vy**2)
-    data["bot_v"] = np.sqrt(data.bot_vx**2 + data.bot_vy**2)
-    data["ego_a"] = np.sqrt(data.ego_ax**2 + data.ego_ay**2)
-    data["bot_a"] = np.sqrt(data.bot_ax**2 + data.bot_ay**2)
+    kinematics["ego_v"] = np.sqrt(kinematics["ego_vx"]**2 + kinematics["ego_vy"]**2)
+    kinematics["bot_v"] = np.sqrt(kinematics["bot_vx"]**2 + kinematics["bot_vy"]**2)
+    kinematics["ego_a"] = np.sqrt(kinematics["ego_ax"]**2 + kinematics["ego_ay"]**2)
+    kinematics["bot_a"] = np.sqrt(kinematics["bot_ax"]**2 + kinematics["bot_ay"]**2)
 
     # calculate actual distance between the ego vehicle and the bot, and current tta for each t
-    data["d_ego_bot"] = np.sqrt((data.ego_x - data.bot_x)**2 + (data.ego_y - data.bot_y)**2)
-    data["tta"] = data.d_ego_bot/data.bot_v
-
-    data["truck_v"] = np.sqrt(data.truck_vx**2 + data.truck_vy**2)
-    data["angle_diff"] = data.truck_angle - data.bot_angle
+    kinematics["d_ego_bot"] = np.sqrt((kinematics["ego_x"] - kinematics["bot_x"])**2
+                                      + (kinematics["ego_y"] - kinematics["bot_y"])**2)
+    # the tta is infinite while the bot is standing still
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kinematics["tta"] = kinematics["d_ego_bot"] / kinematics["bot_v"]
+
+    kinematics["truck_v"] = np.sqrt(data.truck_vx.to_numpy(dtype=float)**2 + data.truck_vy.to_numpy(dtype=float)**2)
+    kinematics["angle_diff"] = data.truck_angle.to_numpy(dtype=float) - data.bot_angle.to_numpy(dtype=float)
+    return kinematics
+
+
+def get_counts(measures):
+    """ Counts of the trials with missing or premature responses in measures, as printed by print_counts. Counts of
+    parts of the data can be added up with add_counts """
+    is_go = measures.is_go_decision
+    return {"n_trials": len(measures),
+            "n_go": int(is_go.sum()),
+            "n_stay": int((~is_go).sum()),
+            # RT_gas is -1 if the bot did not move for some reason or throttle wasn't pressed
+            "n_go_without_throttle": int((is_go & (measures.RT_gas==-1)).sum()),
+            # RT_yield is -1 if the yield button wasn't pressed in a stay decision
+            "stay_without_yield": measures[~is_go & (measures.RT_yield==-1)].groupby(["subj_id"]).size(),
+            "n_go_premature": int((is_go & (measures.RT_gas<=0)).sum()),
+            "n_stay_missing": int((~is_go & (measures.RT_yield<=0)).sum())}
+
+
+def add_counts(counts, other_counts):
+    return {key: (counts[key].add(other_counts[key], fill_value=0).astype(int) if key == "stay_without_yield"
+                  else counts[key] + other_counts[key]) for key in counts}
+
+
+def print_counts(counts):
+    print("Number of trials before exclusions: %i" % counts["n_trials"])
+    print("Number of go trials without a throttle press or bot not moving: %i" % counts["n_go_without_throttle"])
+    print("Number of stay trials without a yield button press: %i" % counts["stay_without_yield"].sum())
+    print(counts["stay_without_yield"])
+    print("Proportion of go trials with premature RT: %.3f" % (counts["n_go_premature"]/counts["n_go"]))
+    print("Proportion of stay trials with missing RT: %.3f" % (counts["n_stay_missing"]/counts["n_stay"]))
+    print("Number of trials after exclusions: %i" % counts["n_trials"])
+
+
+def get_selection(data):
+    # rows of the raw data that process_data keeps, selected at once so that the data is copied only once
+    return (
+        # we are only interested in left turns
+        (data.turn_direction==1)
+        # discarding the filler trials
+        & (data.d_condition==80)
+        # only consider the data recorded within 20 meters of each intersection
+        & (abs(data.ego_distance_to_intersection)<20))
+
+
+def process_data(data, verbose=True):
+    data.loc[:,"t"] = data.t - data.t.groupby(data.index.names).transform("min")
+
+    data = data[get_selection(data)]
+    data = data.rename(columns=PROCESS_RENAMES, copy=False)
+
+    # smooth the time series by filtering out the noise using Savitzky-Golay filter, and add the kinematics derived
+    # from them, which are stored as float32 like the raw kinematics
+    for column, values in get_kinematics(data).items():
+        data[column] = values.astype(np.float32)
 
     # get the DVs and helper variables
-    measures = data.groupby(data.index.names).apply(get_measures)
-    print("Number of trials before exclusions: %i" % len(measures))
+    measures = get_trial_measures(data)
 
     # data = data.join(measures)
     measures["is_go_decision"] = measures.min_distance > 5
 
-    # RT_gas is -1 if the bot did not move for some reason or throttle wasn't pressed
-    print("Number of go trials without a throttle press or bot not moving: %i" % (len(measures[measures.is_go_decision & (measures.RT_gas==-1)])))
-
-    # RT_yield is -1 if the yield button wasn't pressed in a stay decision
-    print("Number of stay trials without a yield button press: %i" % (len(measures[~measures.is_go_decision & (measures.RT_yield==-1)])))
-    print(measures[~measures.is_go_decision & (measures.RT_yield==-1)].groupby(["subj_id"]).size())
-
     # add the condition information to the measures dataframe for further analysis
     conditions = data.loc[:,["tta_0", "d_0", "a_values"]].groupby(data.index.names).first()
     measures = measures.join(conditions)
 
     measures["a_duration"] = 1
-    measures["a_values"] = measures.a_values.apply(ast.literal_eval).apply(tuple)#.apply(str)
+    # a_values are categorical in the raw data
+    measures["a_values"] = measures.a_values.astype(object).apply(ast.literal_eval).apply(tuple)#.apply(str)
 
     # add column "decision" for nicer visualization
     measures["decision"] = "Stay"
@@ -119,30 +334,207 @@ def process_data(data):
     measures["RT"] = measures["RT_gas"]
     measures.loc[~measures.is_go_decision, ["RT"]] = measures.loc[~measures.is_go_decision, ["RT_yield"]].values
 
-    print("Proportion of go trials with premature RT: %.3f" %
-          (len(measures[(measures.RT<=0) & measures.is_go_decision])/len(measures[measures.is_go_decision])))
-
-    print("Proportion of stay trials with missing RT: %.3f" %
-          (len(measures[(measures.RT<=0) & ~measures.is_go_decision])/len(measures[~measures.is_go_decision])))
-
+    # premature RTs of go trials and missing RTs of stay trials are excluded
     measures.loc[measures.RT <= 0, ["RT"]] = np.NaN
 
-    print("Number of trials after exclusions: %i" % len(measures))
+    if verbose:
+        print_counts(get_counts(measures))
 
     return data, measures
 
-data_path = "data"
-
-# Uncomment this line to re-generate merged raw data file from individual raw data files
-# merge_csv_files(data_path=data_path)
+def add_other_columns(data, other_data):
+    # data of process_data with the OTHER_COLUMNS of the same rows, in the column order of processing all raw columns
+    data = pd.concat([data, other_data.set_axis(data.index)], axis=1)
+    columns = [PROCESS_RENAMES.get(column, column) for column in RAW_COLUMNS if column not in RAW_INDEX]
+    return data[columns + [column for column in data.columns if column not in columns]]
+
+
+def get_fingerprint(file_path):
+    # hash of the content of a file
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_raw_log(file_path):
+    # a single raw data file, in the order of read_raw_data
+    raw_data = pd.read_csv(file_path, sep="\t", dtype=RAW_DTYPES, usecols=RAW_COLUMNS)
+    return raw_data.sort_values(RAW_INDEX, kind="stable").set_index(RAW_INDEX)[PROCESS_COLUMNS + OTHER_COLUMNS]
+
+
+def concatenate_csv_files(file_names, merged_file_name):
+    # csv files with the same header merged as text, so that their rows are not parsed and formatted again
+    with open(merged_file_name, "w") as merged_file:
+        for i, file_name in enumerate(file_names):
+            with open(file_name) as file:
+                if i > 0:
+                    # the header
+                    file.readline()
+                shutil.copyfileobj(file, merged_file)
+
+
+def preprocess_raw_log(file_path, cache_path, store_path):
+    # preprocesses a single raw data file into the cache of preprocess_incremental and a part of the trajectory store,
+    # returns the index of its first trial, or None if none of its trials are kept (e.g. a file of filler trials)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    raw_data = read_raw_log(file_path)
+    selection = get_selection(raw_data).to_numpy()
+    if not selection.any():
+        return None
+    data, measures = process_data(raw_data[PROCESS_COLUMNS], verbose=False)
+    data = add_other_columns(data, raw_data.loc[selection, OTHER_COLUMNS])
+    data.to_csv(os.path.join(cache_path, name + "_processed_data.csv"), index=True)
+    trajectory_store.write_part(data, store_path, name)
+    measures.to_pickle(os.path.join(cache_path, name + "_measures.pkl"))
+    return [int(i) for i in data.index[0]]
+
+
+def preprocess_incremental(data_path, n_jobs=1):
+    """ Preprocesses the raw data files in data_path/raw that were added or changed since the last run (in n_jobs
+    worker processes, or in the current process if n_jobs=1), and merges the results of all files into measures.csv
+    and processed_data.csv, with a part of the trajectory store in data_path/processed_data per file. The results of
+    each file are cached in data_path/preprocessed, together with the fingerprints of the file and of this script, so
+    that changes to either invalidate them. Returns the measures """
+    cache_path = os.path.join(data_path, "preprocessed")
+    os.makedirs(cache_path, exist_ok=True)
+    store_path = os.path.join(data_path, "processed_data")
+    manifest_file = os.path.join(cache_path, "manifest.json")
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+    code_fingerprint = get_fingerprint(os.path.abspath(__file__))
 
-print("Merging finalized, preprocessing started...")
-
-raw_data = pd.read_csv(os.path.join(data_path, "raw_data_merged.csv"), sep="\t",
-                       index_col=["subj_id", "session", "route", "intersection_no"])
-processed_data, measures = process_data(raw_data)
+    raw_data_path = os.path.join(data_path, "raw")
+    files = sorted(file for file in os.listdir(raw_data_path) if file.endswith(".txt"))
+    fingerprints = {file: {"file": get_fingerprint(os.path.join(raw_data_path, file)), "code": code_fingerprint}
+                    for file in files}
+    # files are also preprocessed again if their part of the trajectory store is missing, e.g. after a full run
+    changed_files = [file for file in files if manifest.get(file, {}).get("fingerprint") != fingerprints[file]
+                     or (manifest[file]["first_trial"] is not None
+                         and not os.path.isdir(os.path.join(store_path, os.path.splitext(file)[0])))]
+
+    def file_done(file, first_trial):
+        print("Preprocessed %s" % file)
+        manifest[file] = {"fingerprint": fingerprints[file], "first_trial": first_trial}
+        # the manifest is written after each file, so that an interrupted run keeps the files done so far
+        with open(manifest_file, "w") as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=1)
+
+    if n_jobs == 1:
+        for file in changed_files:
+            file_done(file, preprocess_raw_log(os.path.join(raw_data_path, file), cache_path, store_path))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(preprocess_raw_log, os.path.join(raw_data_path, file), cache_path,
+                                       store_path): file for file in changed_files}
+            for future in concurrent.futures.as_completed(futures):
+                file_done(futures[future], future.result())
+
+    # the results of raw data files that were removed are dropped
+    for file in set(manifest) - set(files):
+        name = os.path.splitext(file)[0]
+        for cache_file in [name + "_processed_data.csv", name + "_measures.pkl"]:
+            if os.path.isfile(os.path.join(cache_path, cache_file)):
+                os.remove(os.path.join(cache_path, cache_file))
+        del manifest[file]
+    with open(manifest_file, "w") as file:
+        json.dump(manifest, file, indent=1)
+
+    # the files are merged in the order of their trials, which gives the same processed_data.csv as process_data on
+    # all raw data; files without trials are skipped
+    names = [os.path.splitext(file)[0] for file in sorted((file for file in files
+                                                           if manifest[file]["first_trial"] is not None),
+                                                          key=lambda file: manifest[file]["first_trial"])]
+    trajectory_store.remove_parts(store_path, keep=names)
+    concatenate_csv_files([os.path.join(cache_path, name + "_processed_data.csv") for name in names],
+                          os.path.join(data_path, "processed_data.csv"))
+    measures = pd.concat([pd.read_pickle(os.path.join(cache_path, name + "_measures.pkl"))
+                          for name in names]).sort_index(kind="stable")
+    measures.to_csv(os.path.join(data_path, "measures.csv"), index=True)
+    print_counts(get_counts(measures))
+    return measures
+
+
+def get_partitions(dataset_path):
+    # (subj_id, session) of each partition of the raw dataset, sorted
+    dataset = ds.dataset(dataset_path, schema=RAW_SCHEMA, format="parquet", partitioning=RAW_PARTITIONING)
+    keys = [ds.get_partition_keys(fragment.partition_expression) for fragment in dataset.get_fragments()]
+    return sorted(set((key["subj_id"], key["session"]) for key in keys))
+
+
+def process_partition(dataset_path, partition, processed_data_file, store_path):
+    # process_data of one subject and session of the raw dataset; the processed data is written to processed_data_file
+    # and to a part of the trajectory store in the worker, the measures and their counts are returned (None if none of
+    # its trials are kept)
+    subj_id, session = partition
+    data = read_raw_data(dataset_path, columns=PROCESS_COLUMNS, subj_ids=[subj_id], sessions=[session])
+    selection = get_selection(data).to_numpy()
+    if not selection.any():
+        return None
+    data, measures = process_data(data, verbose=False)
+    # the other columns are only read once the processing is done, so that they are not in memory during it
+    data = add_other_columns(data, read_raw_data(dataset_path, columns=OTHER_COLUMNS, subj_ids=[subj_id],
+                                                 sessions=[session])[selection])
+    data.to_csv(processed_data_file, index=True)
+    trajectory_store.write_part(data, store_path, "%i_%i" % partition)
+    return measures, get_counts(measures)
+
+
+def preprocess_partitions(data_path, n_jobs=1):
+    """ process_data of the raw dataset in data_path/raw_dataset one subject and session at a time, so that only one
+    of them is in memory, either in the current process (n_jobs=1) or split over n_jobs worker processes (None uses all
+    CPUs). Writes the same measures.csv and processed_data.csv as process_data on all data, and the trajectory store
+    data_path/processed_data, and prints the counts of all subjects and sessions combined. Returns the measures """
+    dataset_path = os.path.join(data_path, "raw_dataset")
+    store_path = os.path.join(data_path, "processed_data")
+    partitions = get_partitions(dataset_path)
+    trajectory_store.remove_parts(store_path)
+    with tempfile.TemporaryDirectory(dir=data_path) as temp_path:
+        processed_data_files = [os.path.join(temp_path, "%i_%i.csv" % partition) for partition in partitions]
+        if n_jobs == 1:
+            results = [process_partition(dataset_path, partition, processed_data_file, store_path)
+                       for partition, processed_data_file in zip(partitions, processed_data_files)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                # map returns the results in the order of the partitions, which is the order of the trials
+                results = list(executor.map(process_partition, [dataset_path] * len(partitions), partitions,
+                                            processed_data_files, [store_path] * len(partitions)))
+        # partitions without trials are skipped
+        results, processed_data_files = zip(*[(result, processed_data_file) for result, processed_data_file
+                                              in zip(results, processed_data_files) if result is not None])
+        concatenate_csv_files(processed_data_files, os.path.join(data_path, "processed_data.csv"))
+    measures = pd.concat([measures for measures, counts in results])
+    measures.to_csv(os.path.join(data_path, "measures.csv"), index=True)
+    print_counts(functools.reduce(add_counts, [counts for measures, counts in results]))
+    return measures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="only preprocess the raw data files that were added or changed since the last run")
+    parser.add_argument("--parallel", action="store_true",
+                        help="preprocess the subjects and sessions of the raw dataset in parallel")
+    parser.add_argument("--n_jobs", type=int, default=None,
+                        help="number of worker processes of --parallel and --incremental (default: all CPUs)")
+    parser.add_argument("--convert", action="store_true",
+                        help="convert the raw data files to the raw dataset again (done anyway if it does not exist)")
+    args = parser.parse_args()
+
+    data_path = "data"
+
+    if args.incremental:
+        preprocess_incremental(data_path, n_jobs=args.n_jobs)
+    else:
+        dataset_path = os.path.join(data_path, "raw_dataset")
+        if args.convert or not os.path.isdir(dataset_path):
+            convert_raw_logs(glob.glob(os.path.join(data_path, "raw", "*.txt")), dataset_path)
+            print("Conversion finalized, preprocessing started...")
 
-print("Preprocessing finalized, writing data to csv...")
+        # the subjects and sessions are read and preprocessed one at a time, or in parallel with --parallel
+        preprocess_partitions(data_path, n_jobs=args.n_jobs if args.parallel else 1)
 
-measures.to_csv(os.path.join(data_path, "measures.csv"), index=True)
-processed_data.to_csv(os.path.join(data_path, "processed_data.csv"), index=True)
\ No newline at end of file
+        print("Preprocessing finalized")
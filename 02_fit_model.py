@@ -1,22 +1,34 @@
 import pyddm
 import models
 import loss_functions
+import solver
+import fitting
+import profiling
+import results_store
 import pandas as pd
 import os
 import utils
 from datetime import datetime
 import ast
 
-def fit_model(model, training_data, loss_function):
-    training_sample = pyddm.Sample.from_pandas_dataframe(df=training_data, rt_column_name="RT",
-                                                         choice_column_name="is_go_decision", choice_names=("Go", "Stay"))
-    fitted_model = pyddm.fit_adjust_model(sample=training_sample, model=model, lossfunction=loss_function, verbose=True)
+def get_sample(training_data):
+    return pyddm.Sample.from_pandas_dataframe(df=training_data, rt_column_name="RT",
+                                              choice_column_name="is_go_decision", choice_names=("Go", "Stay"))
+
+def fit_model(model, training_data, loss_function, n_jobs=None):
+    training_sample = get_sample(training_data)
+    solver.solution_cache.clear()
+    if n_jobs is None:
+        fitted_model = fitting.fit_model_differential_evolution(model, training_sample, loss_function)
+    else:
+        # each generation of differential evolution is evaluated by n_jobs worker processes, see fitting.py
+        fitted_model = fitting.fit_model_population(model, training_sample, loss_function, n_jobs=n_jobs)
+    print(solver.solution_cache)
 
     return fitted_model
 
 
-def fit_model_by_condition(model_no=1, subj_idx=0, loss_name="bic", T_dur=4):
-    model = models.get_model(model_no=model_no, T_dur=T_dur)
+def get_exp_data(T_dur):
     exp_data = pd.read_csv("data/measures.csv")
     # This excludes a small fraction of trials with outlier RTs, but also excludes about 800 trials with missing RTs (unless they are replaced by 0 already)
     exp_data = exp_data[(exp_data.RT < T_dur)]
@@ -26,7 +38,20 @@ def fit_model_by_condition(model_no=1, subj_idx=0, loss_name="bic", T_dur=4):
     exp_data = exp_data[(exp_data.a_values == (0.0, 4, 4, 0.0))
                         | (exp_data.a_values == (0.0, 0.0, 0.0, 0.0))
                         | (exp_data.a_values == (0.0, -4, -4, 0.0))]
+    return exp_data
+
 
+def get_warm_start_files(loss_name, subj_id):
+    # earlier fits of this subject and of all subjects pooled, with any of the models (see models.get_nested_parameters)
+    return [os.path.join("modeling/fit_results_%s/model_%i" % (loss_name, model_no), "subj_%s_parameters_fitted.csv" % source_subj_id)
+            for model_no in models.MODEL_COMPONENTS for source_subj_id in dict.fromkeys([str(subj_id), "all"])]
+
+
+def fit_model_by_condition(model_no=1, subj_idx=0, loss_name="bic", T_dur=4, resolutions=None, n_jobs=None, warm_start=False):
+    # if resolutions is given, e.g. fitting.DEFAULT_RESOLUTIONS, the model is fitted coarse-to-fine, see fitting.py
+    # with warm_start, the model is fitted by a local search from the earlier fits in modeling/fit_results_<loss_name>
+    model = models.get_model(model_no=model_no, T_dur=T_dur)
+    exp_data = get_exp_data(T_dur)
     subjects = exp_data.subj_id.unique()
 
     if subj_idx == "all":
@@ -40,7 +65,10 @@ def fit_model_by_condition(model_no=1, subj_idx=0, loss_name="bic", T_dur=4):
     print("len(training_data): " + str(len(training_data)))
 
     if loss_name == "bic":
-        loss = pyddm.LossRobustBIC
+        loss = loss_functions.LossRobustBIC
+    elif loss_name == "bic_binned":
+        # same loss as "bic", but the cost of evaluating it does not grow with the number of trials
+        loss = loss_functions.LossRobustBICBinned
     elif loss_name=="vincent":
         loss = loss_functions.LossWLSVincent
     elif loss_name == "wls":
@@ -56,14 +84,41 @@ def fit_model_by_condition(model_no=1, subj_idx=0, loss_name="bic", T_dur=4):
 
     print(subj_id)
 
-    fitted_model = fit_model(model, training_data, loss)
+    # the subject is part of the file names, as fit_runner.py may start several subjects within the same second
+    log_name = "modeling/logs/%s_model_%i_subj_%s_%s" % (loss_name, model_no, str(subj_id), datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+    os.makedirs("modeling/logs", exist_ok=True)
+
+    seeds = fitting.get_warm_start_seeds(model, get_warm_start_files(loss_name, subj_id)) if warm_start else []
+    if warm_start and not seeds:
+        print("No earlier fits to start from, fitting from scratch")
+    resolution_report = None
+    # every loss evaluation is recorded in the trace file, see profiling.py
+    with profiling.Trace(log_name + "_trace.jsonl", model_no=model_no, subj_id=str(subj_id), loss_name=loss_name):
+        if seeds:
+            solver.solution_cache.clear()
+            fitted_model = fitting.fit_model_warm_start(model, get_sample(training_data), loss, seeds)
+        elif resolutions is None:
+            fitted_model = fit_model(model, training_data, loss, n_jobs=n_jobs)
+        else:
+            fitted_model, resolution_report = fitting.fit_model_multiresolution(model_no, get_sample(training_data), loss,
+                                                                                T_dur, resolutions=resolutions)
     utils.write_to_csv(output_directory, file_name,
                        [subj_id, fitted_model.get_fit_result().value()]
                        + [float(param) for param in fitted_model.get_model_parameters()])
+    # the store is safe to write to from parallel fits, see results_store.py
+    results_store.ResultsStore().add_fit(loss_name, model_no, subj_id, fitted_model.get_fit_result().value(),
+                                         dict(zip(fitted_model.get_model_parameter_names(), fitted_model.get_model_parameters())),
+                                         fitted_model.get_fit_result().properties.get("n_evaluations"))
 
-    with open("modeling/logs/%s_model_%i_%s.txt" % (loss_name, model_no, datetime.now().strftime("%Y-%m-%d-%H-%M-%S")), "w") as outfile:
+    with open(log_name + ".txt", "w") as outfile:
         print(fitted_model, file=outfile)
+        print(solver.solution_cache, file=outfile)
+        if resolution_report is not None:
+            print(resolution_report.to_string(), file=outfile)
+        if os.path.getsize(log_name + "_trace.jsonl") > 0:
+            print(profiling.get_summary(profiling.read_traces([log_name + "_trace.jsonl"])).to_string(), file=outfile)
 
     return fitted_model
 
-fitted_model = fit_model_by_condition(model_no=1, subj_idx="all", loss_name="bic", T_dur=4)
+if __name__ == "__main__":
+    fitted_model = fit_model_by_condition(model_no=1, subj_idx="all", loss_name="bic", T_dur=4)
@@ -0,0 +1,272 @@
+"""
+benchmarks.py
+Benchmarks of the modeling, loss, and preprocessing hot paths on synthetic data, so that they run offline:
+model.solve for each model and condition, one evaluation of each loss function, building the state interpolators,
+process_data, get_measures, and reading the raw data in 00_preprocess_data.py, loading a trial from the trajectory
+store, and the nudge prediction sweep of 03_simulate_fitted_models.ipynb. Results are saved as JSON baselines that
+later runs can be compared against, e.g.
+
+    python benchmarks.py --save benchmark_results/baseline.json
+    python benchmarks.py --compare benchmark_results/baseline.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import importlib
+import contextlib
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyddm
+import models
+import loss_functions
+import simulator
+import solver
+import sweep
+import trajectory_store
+
+# parameters of the synthetic data (model 2 fitted to all subjects)
+SYNTHETIC_PARAMETERS = {"alpha": 0.55, "beta_d": 0.005, "theta": 6.77, "B": 1.33, "x0": 0.67,
+                        "ndt_location": 0.19, "ndt_scale": 0.17}
+
+
+def get_synthetic_raw_data(n_trials, dt=0.02, duration=8., seed=0):
+    """ Raw logs of n_trials left turns in the format of data/raw_data_merged.csv (indexed by the RAW_INDEX of
+    00_preprocess_data.py), with n_trials // 10 extra filler trials that process_data discards. The ego car drives
+    towards the intersection at the origin and either goes before the bot (go) or stops until the bot has passed
+    (stay) """
+    rng = np.random.default_rng(seed)
+    n_total = n_trials + n_trials // 10
+    n_samples = int(duration / dt)
+    t = np.arange(n_samples) * dt
+    conditions = models.get_conditions()
+    condition = [conditions[i] for i in rng.integers(len(conditions), size=n_total)]
+    is_filler = np.arange(n_total) >= n_trials
+    is_go = rng.random(n_total) < 0.5
+    t_visible = rng.uniform(1.5, 2.5, size=n_total)[:, None]
+    RT = rng.uniform(0.3, 1.5, size=n_total)[:, None]
+
+    # the ego car drives along x at 5 m/s, or stops 4 m before the intersection until the bot has passed
+    t_resume = np.where(is_go[:, None], RT, 5.5) + t_visible
+    ego_x = -25 + 5 * t
+    ego_x = np.where(is_go[:, None], ego_x, np.where(t < t_resume, np.minimum(ego_x, -4), -4 + 5 * (t - t_resume)))
+    ego_vx = np.gradient(ego_x, dt, axis=1)
+    # the bot starts driving along y at 8 m/s when it becomes visible
+    bot_y = -40 + 8 * np.maximum(t - t_visible, 0)
+    bot_vy = np.where(t > t_visible, 8., 0.)
+
+    def noise(scale=0.01):
+        return rng.normal(scale=scale, size=(n_total, n_samples))
+
+    raw = {"ego_x": ego_x + noise(), "ego_y": noise(), "ego_vx": ego_vx + noise(), "ego_vy": noise(),
+           "ego_ax": np.gradient(ego_vx, dt, axis=1) + noise(), "ego_ay": noise(), "ego_yaw": noise(),
+           "bot_x": np.zeros_like(bot_y), "bot_y": bot_y, "bot_vx": np.zeros_like(bot_y), "bot_vy": bot_vy,
+           "bot_ax": np.zeros_like(bot_y), "bot_ay": np.zeros_like(bot_y), "bot_yaw": np.full_like(bot_y, 90.),
+           "throttle": np.where(t > t_resume, 0.5, 0.),
+           "brake": np.zeros_like(bot_y), "steer": noise(),
+           "let_pass": (~is_go[:, None] & (t > t_visible + RT)).astype(int),
+           "subjective_good": np.zeros_like(bot_y, dtype=int),
+           "subjective_bad": (rng.random((n_total, 1)) < 0.1) & (t > duration - 1),
+           "truck_x": np.full_like(bot_y, -8.), "truck_y": np.full_like(bot_y, 3.), "truck_vx": np.zeros_like(bot_y),
+           "truck_vy": np.zeros_like(bot_y), "truck_ax": np.zeros_like(bot_y), "truck_ay": np.zeros_like(bot_y),
+           "truck_yaw": np.zeros_like(bot_y)}
+    raw = {column: np.asarray(values).ravel() for column, values in raw.items()}
+    trial = np.repeat(np.arange(n_total), n_samples)
+    raw.update({"subj_id": trial % 20 + 1, "session": 1, "route": trial // 20 % 4 + 1,
+                "intersection_no": trial // 80 + 1,
+                "intersection_x": 0, "intersection_y": 0, "turn_direction": 1,
+                # the clock of the logs does not start at 0
+                "t": np.tile(t, n_total) + 100 * trial,
+                "ego_distance_to_intersection": -raw["ego_x"],
+                "tta_condition": np.array([c["tta_0"] for c in condition])[trial],
+                "d_condition": np.where(is_filler, 90., 80.)[trial],
+                "v_condition": 8., "truck_angle": 0., "bot_angle": 90.,
+                "accl_profile_values": np.array([str(list(c["a_values"])) for c in condition])[trial],
+                "accl_profile_times": "[0.0, 0.5, 1.0, 1.5]"})
+    raw["subjective_bad"] = raw["subjective_bad"].astype(int)
+    preprocess = get_preprocess_module()
+    return pd.DataFrame(raw)[preprocess.RAW_COLUMNS].set_index(preprocess.RAW_INDEX)
+
+
+def get_synthetic_measures(n_trials, seed=0):
+    """ Trials simulated with model 2 in the format of data/measures.csv (see simulator.py), n_trials per condition,
+    with RT < 4 as in 02_fit_model.py """
+    model = models.get_model(2, T_dur=4)
+    model.set_model_parameters([SYNTHETIC_PARAMETERS[name] for name in model.get_model_parameter_names()])
+    measures = simulator.simulate_measures(model, models.get_conditions(), n_trials, seed=seed).reset_index()
+    measures["subj_id"] = measures.intersection_no % 20 + 1
+    measures = measures[measures.RT < 4]
+    return measures[["subj_id", "tta_0", "d_0", "a_values", "a_duration", "is_go_decision", "RT"]]
+
+
+def time_call(function, n_repeats, setup=None):
+    # the best of n_repeats wall clock times, the least noisy estimate of what the code itself costs
+    times = []
+    for i in range(n_repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def get_preprocess_module():
+    # the module name starts with a digit, so it can only be imported with importlib
+    return importlib.import_module("00_preprocess_data")
+
+
+def benchmark_solve(n_repeats, **kwargs):
+    results = {}
+    for model_no in sorted(models.MODEL_COMPONENTS):
+        model = models.get_model(model_no, T_dur=4)
+        model.set_model_parameters(models.get_nested_parameters(model, SYNTHETIC_PARAMETERS))
+        for i, condition in enumerate(models.get_conditions()):
+            results["solve/model_%i/condition_%i" % (model_no, i)] = time_call(lambda: model.solve(condition),
+                                                                               n_repeats)
+    return results
+
+
+def benchmark_losses(n_repeats, n_trials, **kwargs):
+    measures = get_synthetic_measures(n_trials)
+    sample = pyddm.Sample.from_pandas_dataframe(df=measures, rt_column_name="RT", choice_column_name="is_go_decision",
+                                                choice_names=("Go", "Stay"))
+    results = {}
+    for model_no in [2, 8]:
+        model = models.get_model(model_no, T_dur=4)
+        model.set_model_parameters(models.get_nested_parameters(model, SYNTHETIC_PARAMETERS))
+        for loss in [loss_functions.LossRobustBIC, loss_functions.LossWLS, loss_functions.LossWLSVincent]:
+            loss_function = loss(sample, required_conditions=model.required_conditions, T_dur=model.T_dur,
+                                 dt=model.dt, method=None, nparams=len(model.get_model_parameters()),
+                                 samplesize=len(sample))
+            # without the solution cache, each evaluation solves the model
+            results["loss/%s/model_%i" % (loss.__name__, model_no)] = time_call(
+                lambda: loss_function.loss(model), n_repeats, setup=solver.solution_cache.clear)
+    return results
+
+
+def benchmark_state_interpolators(n_repeats, **kwargs):
+    conditions = models.get_conditions()
+    return {"state_interpolators/per_condition": time_call(lambda: models.get_state_interpolators(conditions, T_dur=4),
+                                                           n_repeats),
+            "state_interpolators/state_table": time_call(
+                lambda: models.get_state_interpolators(conditions, T_dur=4, dt=0.005), n_repeats,
+                setup=models.get_state_table.cache_clear)}
+
+
+def benchmark_preprocessing(n_repeats, n_raw_trials, **kwargs):
+    preprocess = get_preprocess_module()
+    raw_data = get_synthetic_raw_data(n_raw_trials)
+    results = {}
+    # process_data prints its progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        results["preprocess/process_data"] = time_call(lambda: preprocess.process_data(raw_data.copy()), n_repeats)
+        data, measures = preprocess.process_data(raw_data.copy())
+    results["preprocess/get_measures"] = time_call(lambda: preprocess.get_trial_measures(data), n_repeats)
+
+    # reading the columns used by process_data from the merged csv file and from the raw dataset
+    with tempfile.TemporaryDirectory() as data_path:
+        raw_data.to_csv(os.path.join(data_path, "raw_data_merged.csv"), sep="\t")
+        with contextlib.redirect_stdout(io.StringIO()):
+            preprocess.convert_raw_logs([os.path.join(data_path, "raw_data_merged.csv")],
+                                        os.path.join(data_path, "raw_dataset"))
+        results["preprocess/read_csv"] = time_call(
+            lambda: pd.read_csv(os.path.join(data_path, "raw_data_merged.csv"), sep="\t",
+                                index_col=preprocess.RAW_INDEX), n_repeats)
+        results["preprocess/read_raw_data"] = time_call(
+            lambda: preprocess.read_raw_data(os.path.join(data_path, "raw_dataset"),
+                                             columns=preprocess.PROCESS_COLUMNS), n_repeats)
+
+        trajectory_store.write_part(data, os.path.join(data_path, "processed_data"), "all")
+        store = trajectory_store.TrajectoryStore(os.path.join(data_path, "processed_data"))
+        trial = store.trials[trajectory_store.TRIAL_INDEX].iloc[len(store.trials) // 2]
+        results["preprocess/get_trial"] = time_call(lambda: store.get_trial(*trial), n_repeats)
+    return results
+
+
+def benchmark_sweep(n_repeats, **kwargs):
+    # the nudge predictions of 03_simulate_fitted_models.ipynb, in a single process
+    conditions = [{"tta_0": 6, "d_0": 90, "a_values": (0.0, -a_magnitude, a_magnitude, 0.0), "a_duration": a_duration}
+                  for a_duration in np.linspace(0.1, 2.5, 11) for a_magnitude in np.linspace(0.5, 5.0, 10)]
+    parameters = pd.DataFrame([dict(SYNTHETIC_PARAMETERS, subj_id="all")])
+
+    def run_sweep():
+        with tempfile.TemporaryDirectory() as output_dir:
+            sweep.run_sweep(2, parameters, conditions, output_dir, T_dur=5.5, n_jobs=1, verbose=False)
+
+    return {"sweep/nudge_predictions": time_call(run_sweep, n_repeats)}
+
+
+BENCHMARKS = {"solve": benchmark_solve, "loss": benchmark_losses, "state_interpolators": benchmark_state_interpolators,
+              "preprocess": benchmark_preprocessing, "sweep": benchmark_sweep}
+
+
+def run_benchmarks(names=None, n_repeats=3, n_trials=100, n_raw_trials=200, verbose=True):
+    """ Runs the benchmarks in names (keys of BENCHMARKS, all by default) and returns the best time of n_repeats
+    of each. n_trials is the number of synthetic trials per condition for the losses, n_raw_trials the number of
+    synthetic raw trials for preprocessing """
+    results = {}
+    for name in (names or BENCHMARKS):
+        start = time.perf_counter()
+        results.update(BENCHMARKS[name](n_repeats=n_repeats, n_trials=n_trials, n_raw_trials=n_raw_trials))
+        if verbose:
+            print("%s: %.1f s" % (name, time.perf_counter() - start))
+    return {"created": datetime.now().strftime("%Y-%m-%d-%H-%M-%S"), "commit": get_commit(),
+            "platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+            "pyddm": pyddm.__version__, "n_repeats": n_repeats, "n_trials": n_trials, "n_raw_trials": n_raw_trials,
+            "results": results}
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def save_baseline(benchmark, file_name):
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    with open(file_name, "w") as f:
+        json.dump(benchmark, f, indent=1)
+
+
+def compare(benchmark, baseline_file, tolerance=0.2):
+    """ Times of benchmark and of the baseline in baseline_file, with their ratio. Benchmarks that take more than
+    (1 + tolerance) times as long as the baseline are marked as regressions """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    # only the benchmarks that were run; those that are new have no baseline
+    comparison = pd.DataFrame({"baseline_s": pd.Series(baseline["results"]),
+                               "current_s": pd.Series(benchmark["results"])}).loc[list(benchmark["results"])]
+    comparison["ratio"] = comparison.current_s / comparison.baseline_s
+    comparison["is_regression"] = comparison.ratio > 1 + tolerance
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the modeling, loss, and preprocessing hot paths")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, of %s (default: all)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--save", help="json file to save the results to")
+    parser.add_argument("--compare", help="json file of a baseline to compare the results with")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    benchmark = run_benchmarks(args.names, n_repeats=args.repeats)
+    pd.set_option("display.width", 200)
+    if args.save:
+        save_baseline(benchmark, args.save)
+    if args.compare:
+        comparison = compare(benchmark, args.compare, tolerance=args.tolerance)
+        print(comparison.to_string())
+        sys.exit(int(comparison.is_regression.any()))
+    else:
+        print(pd.Series(benchmark["results"], name="seconds").to_string())
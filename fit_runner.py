@@ -0,0 +1,126 @@
+"""
+fit_runner.py
+Runs fit_model_by_condition of 02_fit_model.py for every (model_no x subj_idx x loss_name) combination in a process
+pool. Each finished job is recorded in a csv file together with its loss, number of loss evaluations, and wall time,
+so that an interrupted run skips the finished jobs when it is started again
+"""
+
+import os
+import time
+import importlib
+import concurrent.futures
+from datetime import datetime
+import pandas as pd
+import utils
+
+JOB_COLUMNS = ["model_no", "subj_idx", "loss_name", "subj_id", "loss", "n_evaluations", "wall_time", "finished_at"]
+
+
+def get_jobs(model_nos, subj_idxs, loss_names):
+    return [{"model_no": model_no, "subj_idx": subj_idx, "loss_name": loss_name}
+            for loss_name in loss_names for model_no in model_nos for subj_idx in subj_idxs]
+
+
+def get_job_key(job):
+    # subj_idx is an int or "all", and is read back from the csv file as a string
+    return int(job["model_no"]), str(job["subj_idx"]), job["loss_name"]
+
+
+def get_finished_jobs(jobs_file):
+    if not os.path.isfile(jobs_file):
+        return set()
+    finished = pd.read_csv(jobs_file, dtype={"subj_idx": str})
+    return set(get_job_key(job) for job in finished.to_dict(orient="records"))
+
+
+def get_fit_module():
+    # the module name starts with a digit, so it can only be imported with importlib
+    return importlib.import_module("02_fit_model")
+
+
+def run_job(job, T_dur, resolutions, fit_n_jobs, warm_start):
+    start_time = time.perf_counter()
+    fitted_model = get_fit_module().fit_model_by_condition(model_no=job["model_no"], subj_idx=job["subj_idx"],
+                                                           loss_name=job["loss_name"], T_dur=T_dur,
+                                                           resolutions=resolutions, n_jobs=fit_n_jobs,
+                                                           warm_start=warm_start)
+    fit_result = fitted_model.get_fit_result()
+    return dict(job, loss=fit_result.value(), n_evaluations=fit_result.properties.get("n_evaluations"),
+                wall_time=time.perf_counter() - start_time,
+                finished_at=datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+
+
+def write_job(jobs_file, record):
+    # "." for a jobs_file without a directory, which os.makedirs does not accept as ""
+    directory = os.path.dirname(jobs_file) or "."
+    if not os.path.isfile(jobs_file):
+        utils.write_to_csv(directory, os.path.basename(jobs_file), JOB_COLUMNS, write_mode="w")
+    utils.write_to_csv(directory, os.path.basename(jobs_file), [record[column] for column in JOB_COLUMNS])
+
+
+def run_fit_jobs(model_nos, subj_idxs, loss_names, n_jobs=None, T_dur=4, resolutions=None, fit_n_jobs=None,
+                 warm_start=False, jobs_file="modeling/fit_jobs.csv", verbose=True):
+    """ Fits all combinations of model_nos, subj_idxs (ints, or "all"), and loss_names with n_jobs worker processes
+    (n_jobs=1 runs in the current process, n_jobs=None uses all CPUs). Jobs recorded in jobs_file are skipped.
+    resolutions, fit_n_jobs, and warm_start are passed on to fit_model_by_condition; as the jobs already run in
+    parallel, fit_n_jobs is best left at None (a serial fit per job). Returns the records of all finished jobs.
+    A job that fails is not recorded, so that it is run again next time, and does not stop the other jobs; a
+    RuntimeError listing the failed jobs is raised once all jobs are done """
+    finished_jobs = get_finished_jobs(jobs_file)
+    jobs = [job for job in get_jobs(model_nos, subj_idxs, loss_names) if get_job_key(job) not in finished_jobs]
+    subjects = get_fit_module().get_exp_data(T_dur).subj_id.unique()
+    if verbose:
+        print("%i of %i jobs left" % (len(jobs), len(model_nos) * len(subj_idxs) * len(loss_names)))
+
+    def get_subj_id(subj_idx):
+        return "all" if subj_idx == "all" else subjects[subj_idx]
+
+    def job_done(i, record):
+        # only the main process writes to jobs_file
+        record["subj_id"] = get_subj_id(record["subj_idx"])
+        write_job(jobs_file, record)
+        if verbose:
+            print("%i/%i jobs done: model %i, subject %s, %s loss %.4f, %s evaluations in %.1f s"
+                  % (i + 1, len(jobs), record["model_no"], record["subj_id"], record["loss_name"], record["loss"],
+                     record["n_evaluations"], record["wall_time"]))
+
+    # descriptions and exceptions of the jobs that failed
+    failed_jobs = []
+
+    def job_failed(i, job, exception):
+        failed_jobs.append(("model %i, subject %s, %s" % (job["model_no"], get_subj_id(job["subj_idx"]),
+                                                          job["loss_name"]), exception))
+        if verbose:
+            print("%i/%i jobs done: %s failed: %r" % (i + 1, len(jobs), failed_jobs[-1][0], exception))
+
+    if n_jobs == 1:
+        for i, job in enumerate(jobs):
+            try:
+                record = run_job(job, T_dur, resolutions, fit_n_jobs, warm_start)
+            except Exception as exception:
+                job_failed(i, job, exception)
+            else:
+                job_done(i, record)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(run_job, job, T_dur, resolutions, fit_n_jobs, warm_start): job for job in jobs}
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                try:
+                    record = future.result()
+                except Exception as exception:
+                    job_failed(i, futures[future], exception)
+                else:
+                    job_done(i, record)
+
+    if failed_jobs:
+        raise RuntimeError("%i of %i jobs failed: %s" % (len(failed_jobs), len(jobs), "; ".join(
+            "%s: %r" % failed_job for failed_job in failed_jobs))) from failed_jobs[0][1]
+    if not os.path.isfile(jobs_file):
+        # no job has been recorded yet
+        return pd.DataFrame(columns=JOB_COLUMNS)
+    return pd.read_csv(jobs_file, dtype={"subj_idx": str})
+
+
+if __name__ == "__main__":
+    n_subjects = len(get_fit_module().get_exp_data(T_dur=4).subj_id.unique())
+    run_fit_jobs(model_nos=range(1, 9), subj_idxs=["all"] + list(range(n_subjects)), loss_names=["bic"])
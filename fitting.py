@@ -0,0 +1,274 @@
+"""
+fitting.py
+Coarse-to-fine (multi-resolution) model fitting. The global search (differential evolution) runs on a coarse dt/dx
+grid, where solving the model is cheap. The best candidates are then refined by a bounded local search on
+progressively finer grids, so that only the last few hundred loss evaluations are made at full resolution.
+
+It also provides population-batched differential evolution: all parameter sets of a generation are evaluated with
+one call, which splits the population over a pool of worker processes that keep the model and the loss function
+(with its sample and state tables) resident. Warm-start fitting replaces the global search by a local search from
+parameters of earlier fits, e.g. the pooled fit of all subjects, or the fit of a nested model
+"""
+
+import os
+import copy
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import pyddm
+import models
+
+# (dt, dx) of each level, from coarse to fine; the last level is the resolution of the final model
+DEFAULT_RESOLUTIONS = [(0.02, 0.02), (0.01, 0.01), (0.005, 0.005)]
+
+
+def get_candidates(evaluations, n_candidates):
+    # the best distinct parameter vectors among all (x, loss) evaluations
+    candidates = []
+    for x, loss in sorted(evaluations, key=lambda evaluation: evaluation[1]):
+        if not any(np.allclose(x, candidate) for candidate in candidates):
+            candidates.append(x)
+        if len(candidates) == n_candidates:
+            break
+    return candidates
+
+
+def minimize_local(fitness, x, constraints, maxfev, tolerance):
+    # Nelder-Mead rather than the L-BFGS-B polishing of differential_evolution: the loss is piecewise constant in
+    # a constant bound B between grid points (pyddm aligns the x domain to dx), so its numerical gradient is 0
+    return scipy.optimize.minimize(fitness, x, method="Nelder-Mead", bounds=constraints,
+                                   options={"maxfev": maxfev, "fatol": tolerance, "xatol": 1e-4, "adaptive": True})
+
+
+def refine(fitness, candidates, constraints, maxfev, tolerance):
+    # local search from each candidate; returns the results sorted by loss and the loss of the first (best)
+    # candidate before refinement
+    loss_start = fitness(candidates[0])
+    results = [minimize_local(fitness, candidate, constraints, maxfev, tolerance) for candidate in candidates]
+    return sorted(results, key=lambda result: result.fun), loss_start
+
+
+def set_n_evaluations(fitted_model, n_evaluations):
+    # kept with the fit result, e.g. for the job records of fit_runner.py
+    fitted_model.get_fit_result().properties["n_evaluations"] = int(n_evaluations)
+
+
+def fit_model_differential_evolution(model, sample, loss_function, fitparams=None, verbose=True):
+    """ pyddm.fit_adjust_model with its default fitting method (differential evolution), which also records the
+    number of loss evaluations """
+    results = []
+
+    def search(fitness, x_0, constraints):
+        results.append(scipy.optimize.differential_evolution(fitness, constraints,
+                                                             **dict({"disp": verbose}, **(fitparams or {}))))
+        return results[-1]
+
+    fitted_model = pyddm.fit_adjust_model(sample=sample, model=model, lossfunction=loss_function,
+                                          fitting_method=search, verbose=verbose)
+    set_n_evaluations(fitted_model, results[-1].nfev)
+    return fitted_model
+
+
+def restart_local(fitness, result, constraints, get_n_evaluations, maxfev, tolerance):
+    # restarts the local search from the best point so far until the loss improves by less than tolerance, or
+    # get_n_evaluations() reaches maxfev
+    while get_n_evaluations() < maxfev:
+        restart = minimize_local(fitness, result.x, constraints, maxfev - get_n_evaluations(), tolerance)
+        improvement = result.fun - restart.fun
+        result = restart if restart.fun < result.fun else result
+        if improvement < tolerance:
+            break
+    return result
+
+
+def fit_model_multiresolution(model_no, sample, loss_function, T_dur, resolutions=DEFAULT_RESOLUTIONS,
+                              n_candidates=5, maxfev=100, final_maxfev=300, tolerance=1e-3, fitparams=None,
+                              verbose=True):
+    """ Fits the model by differential evolution at the first (coarsest) resolution, then refines the n_candidates
+    best parameter sets found so far with at most maxfev loss evaluations each at every intermediate resolution.
+    At the final resolution only the best candidate is refined, restarting the local search until the loss improves
+    by less than tolerance or final_maxfev evaluations are spent.
+
+    Returns the fitted model at the final resolution and a DataFrame with the number of loss evaluations and
+    the change in loss at each level: loss_start is the best parameter set of the previous level evaluated
+    at this level's resolution, so loss_start - previous loss is the effect of the grid, and loss - loss_start
+    the effect of refinement """
+    report = []
+    candidates = None
+    for level, (dt, dx) in enumerate(resolutions):
+        model = models.get_model(model_no, T_dur, dt=dt, dx=dx)
+        is_final = (level == len(resolutions) - 1)
+        evaluations = []
+        loss_start = np.nan
+
+        def search(fitness, x_0, constraints):
+            nonlocal loss_start
+
+            def logged_fitness(x):
+                loss = fitness(x)
+                evaluations.append((np.array(x), loss))
+                return loss
+
+            if candidates is None:
+                # local refinement happens at the finer levels, so the global search does not need to polish
+                return scipy.optimize.differential_evolution(logged_fitness, constraints,
+                                                             **dict({"polish": False}, **(fitparams or {})))
+            elif not is_final:
+                results, loss_start = refine(logged_fitness, candidates, constraints, maxfev, tolerance)
+                return results[0]
+            else:
+                results, loss_start = refine(logged_fitness, candidates[:1], constraints, final_maxfev, tolerance)
+                return restart_local(logged_fitness, results[0], constraints, lambda: len(evaluations), final_maxfev,
+                                     tolerance)
+
+        fitted_model = pyddm.fit_adjust_model(sample=sample, model=model, lossfunction=loss_function,
+                                              fitting_method=search, verbose=False)
+        loss = fitted_model.get_fit_result().value()
+        report.append({"level": level, "dt": dt, "dx": dx, "n_evaluations": len(evaluations),
+                       "loss_start": loss_start, "loss": loss,
+                       "loss_change": loss - report[-1]["loss"] if report else np.nan})
+        if verbose:
+            print("Level %i (dt=%g, dx=%g): %i evaluations, loss %.4f (start %.4f)"
+                  % (level, dt, dx, len(evaluations), loss, loss_start))
+        candidates = get_candidates(evaluations, n_candidates)
+
+    report = pd.DataFrame(report)
+    set_n_evaluations(fitted_model, report.n_evaluations.sum())
+    return fitted_model, report
+
+
+def get_warm_start_seeds(model, parameter_files):
+    """ Parameter vectors of model from all fits stored in parameter_files (subj_*_parameters_fitted.csv of this or
+    other models, see models.get_nested_parameters), clipped to the parameter bounds. Missing files are skipped """
+    bounds = np.array([(parameter.minval, parameter.maxval) for parameter in model.get_model_parameters()])
+    seeds = []
+    for parameter_file in parameter_files:
+        if os.path.isfile(parameter_file):
+            for parameters in pd.read_csv(parameter_file).to_dict(orient="records"):
+                seeds.append(np.clip(models.get_nested_parameters(model, parameters), bounds[:, 0], bounds[:, 1]))
+    return get_candidates([(seed, 0) for seed in seeds], len(seeds))
+
+
+def fit_model_warm_start(model, sample, loss_function, seeds, maxfev=300, tolerance=1e-3, verbose=True):
+    """ Fits the model by a local search from the best of the seeds (see get_warm_start_seeds) instead of a global
+    search. As at the final level of fit_model_multiresolution, the local search is restarted until the loss improves
+    by less than tolerance or maxfev loss evaluations are spent, not counting the evaluations of the seeds """
+    evaluations = []
+
+    def search(fitness, x_0, constraints):
+        def logged_fitness(x):
+            loss = fitness(x)
+            evaluations.append((np.array(x), loss))
+            return loss
+
+        for seed in seeds:
+            logged_fitness(seed)
+        x_start, loss_start = min(evaluations, key=lambda evaluation: evaluation[1])
+        if verbose:
+            print("Warm start from the best of %i seeds, loss %.4f" % (len(seeds), loss_start))
+        result = minimize_local(logged_fitness, x_start, constraints, maxfev, tolerance)
+        return restart_local(logged_fitness, result, constraints, lambda: len(evaluations) - len(seeds), maxfev,
+                             tolerance)
+
+    fitted_model = pyddm.fit_adjust_model(sample=sample, model=model, lossfunction=loss_function,
+                                          fitting_method=search, verbose=False)
+    set_n_evaluations(fitted_model, len(evaluations))
+    return fitted_model
+
+
+def get_loss_function(model, sample, loss_function):
+    # the loss function as set up by pyddm.fit_adjust_model
+    components = [model.get_dependence(name) for name in ["drift", "noise", "bound", "IC", "overlay"]]
+    required_conditions = list(set(condition for component in components
+                                   for condition in component.required_conditions))
+    return loss_function(sample, required_conditions=required_conditions, T_dur=model.T_dur, dt=model.dt,
+                         method=None, nparams=len(model.get_model_parameters()), samplesize=len(sample))
+
+
+class PopulationLoss:
+    """ Loss of each row of a (population x parameters) matrix, with the parameters ordered as in
+    model.get_model_parameter_names(). With n_jobs=1 the population is evaluated in the current process, otherwise
+    it is split in n_jobs chunks that are evaluated by worker processes (n_jobs=None uses all CPUs).
+    Use as a context manager, or call close(), to shut the workers down """
+
+    def __init__(self, model, sample, loss_function, n_jobs=None):
+        self.model = copy.deepcopy(model)
+        self.bounds = np.array([(parameter.minval, parameter.maxval) for parameter in model.get_model_parameters()])
+        self.n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+        self.executor = None
+        if self.n_jobs == 1:
+            self.loss_function = get_loss_function(self.model, sample, loss_function)
+        else:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.n_jobs,
+                                                                   initializer=init_worker,
+                                                                   initargs=(model, sample, loss_function))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __call__(self, population):
+        population = np.atleast_2d(population)
+        if self.executor is not None:
+            chunks = np.array_split(population, min(self.n_jobs, len(population)))
+            return np.concatenate(list(self.executor.map(evaluate_worker, chunks)))
+
+        # as in pyddm.fit_adjust_model, parameters that are out of bounds by rounding errors are clipped
+        population = np.clip(population, self.bounds[:, 0], self.bounds[:, 1])
+        # one member at a time: stacking the members in one solver system was not faster, as all of them are then
+        # padded to the widest x domain and solved until the last one has decided
+        losses = np.empty(len(population))
+        for i, x in enumerate(population):
+            self.model.set_model_parameters(x)
+            losses[i] = self.loss_function.loss(self.model)
+        return losses
+
+
+# PopulationLoss of a worker process, created once by init_worker
+worker_population_loss = None
+
+
+def init_worker(model, sample, loss_function):
+    global worker_population_loss
+    worker_population_loss = PopulationLoss(model, sample, loss_function, n_jobs=1)
+
+
+def evaluate_worker(population):
+    return worker_population_loss(population)
+
+
+def fit_model_population(model, sample, loss_function, n_jobs=None, fitparams=None, verbose=True):
+    """ pyddm.fit_adjust_model with differential evolution, evaluating each generation at once with PopulationLoss.
+    fitparams are passed to scipy.optimize.differential_evolution; note that a batched generation implies
+    updating="deferred" (pyddm's default is "immediate"), so the search path differs from that of an unbatched fit """
+    results = []
+    # parameter vectors evaluated by the last search; with vectorized=True, scipy's nfev counts a generation only once
+    n_evaluations = 0
+    with PopulationLoss(model, sample, loss_function, n_jobs=n_jobs) as population_loss:
+        def batched_fitness(x):
+            # scipy passes the population as (parameters x population), and a single vector when polishing
+            nonlocal n_evaluations
+            x = np.asarray(x)
+            n_evaluations += len(x.T) if x.ndim == 2 else 1
+            return population_loss(x.T) if x.ndim == 2 else population_loss(x)[0]
+
+        def search(fitness, x_0, constraints):
+            nonlocal n_evaluations
+            n_evaluations = 0
+            results.append(scipy.optimize.differential_evolution(batched_fitness, constraints,
+                                                                 **dict({"vectorized": True, "updating": "deferred",
+                                                                         "disp": verbose}, **(fitparams or {}))))
+            return results[-1]
+
+        fitted_model = pyddm.fit_adjust_model(sample=sample, model=model, lossfunction=loss_function,
+                                              fitting_method=search, verbose=False)
+    set_n_evaluations(fitted_model, n_evaluations)
+    return fitted_model
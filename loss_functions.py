@@ -1,7 +1,54 @@
+import collections
+import types
 import numpy as np
-from scipy import interpolate, optimize
 import pyddm
 import pandas as pd
+import solver
+import profiling
+
+# empirical probability and RT quantiles of one choice in one condition (rt_quantiles is None if prob is 0)
+EmpiricalSummary = collections.namedtuple("EmpiricalSummary", ["prob", "rt_quantiles"])
+
+
+class LossRobustBIC(pyddm.LossRobustBIC):
+    loss = profiling.traced(pyddm.LossRobustBIC.loss)
+
+    def cache_by_conditions(self, model):
+        # the condition combinations of the sample are the keys of hist_indexes, built in setup
+        return solver.solve_sample(model, self.sample, method=self.method,
+                                   conditions=[dict(c) for c in self.hist_indexes])
+
+
+class LossRobustBICBinned(LossRobustBIC):
+    """ Same value as LossRobustBIC, but the RTs of each condition and choice are histogrammed on the model's time grid
+    once per fit, using the same bins as pyddm (round(RT / dt)). The log-likelihood is then a dot product of the
+    counts with the log-densities, so the cost of a loss evaluation does not depend on the number of trials """
+    name = "BIC (binned RTs)"
+
+    def setup(self, **kwargs):
+        super().setup(**kwargs)
+        # (bins, counts) of the upper (Go) and lower (Stay) RTs, only for the bins that contain RTs
+        self.hist_counts = {c: tuple(np.unique(np.asarray(indexes, dtype=int), return_counts=True)
+                                     for indexes in (choice_upper, choice_lower))
+                            for c, (choice_upper, choice_lower, undec) in self.hist_indexes.items()}
+
+    @profiling.traced
+    def loss(self, model):
+        assert model.dt == self.dt and model.T_dur == self.T_dur
+        solutions = self.cache_by_conditions(model)
+        loglikelihood = 0
+        for c, ((upper_bins, upper_counts), (lower_bins, lower_counts)) in self.hist_counts.items():
+            # as in pyddm.LossLikelihood, negative densities (e.g. from extreme parameters during the fit) give an
+            # infinite loss rather than a NaN
+            with np.errstate(all="raise", under="ignore"):
+                try:
+                    pdf_upper, pdf_lower = solutions[c].pdf("_top"), solutions[c].pdf("_bottom")
+                    loglikelihood += np.dot(upper_counts, np.log(pdf_upper[upper_bins] + self._robustness_param))
+                    loglikelihood += np.dot(lower_counts, np.log(pdf_lower[lower_bins] + self._robustness_param))
+                except FloatingPointError:
+                    return np.inf
+        return np.log(self.samplesize) * self.nparams - 2 * loglikelihood
+
 
 class LossWLS(pyddm.LossFunction):
     name = "Weighted least squares as described in Ratcliff & Tuerlinckx 2002"
@@ -11,34 +58,58 @@ class LossWLS(pyddm.LossFunction):
     def setup(self, dt, T_dur, **kwargs):
         self.dt = dt
         self.T_dur = T_dur
+        # the data side of the loss does not depend on the model parameters, so the empirical choice probabilities
+        # and RT quantiles of each condition are computed once per fit rather than on every loss evaluation
+        t_domain = np.arange(0., T_dur + 0.1 * dt, dt)  # same as model.t_domain()
+        empirical_summaries = {}
+        for comb in self.sample.condition_combinations(required_conditions=self.required_conditions):
+            comb_sample = self.sample.subset(**comb)
+            self.comb_rts = pd.DataFrame([[item[0], item[1]["subj_id"]] for item in comb_sample.items(choice="Go")],
+                                         columns=["RT", "subj_id"])
+            summary = {}
+            for choice in ["Go", "Stay"]:
+                prob = comb_sample.prob(choice=choice)
+                rt_quantiles = None
+                if prob > 0:
+                    rt_quantiles = np.asarray(self.get_rt_quantiles(comb_sample.cdf(choice=choice, T_dur=T_dur, dt=dt),
+                                                                    t_domain, exp=True), dtype=float)
+                    rt_quantiles.flags.writeable = False
+                summary[choice] = EmpiricalSummary(prob, rt_quantiles)
+            empirical_summaries[frozenset(comb.items())] = types.MappingProxyType(summary)
+        self.empirical_summaries = types.MappingProxyType(empirical_summaries)
+
+    def cache_by_conditions(self, model):
+        return solver.solve_sample(model, self.sample, method=self.method,
+                                   conditions=[dict(c) for c in self.empirical_summaries])
 
     def get_rt_quantiles(self, cdf, t_domain, exp=False):
         # cdf = x.cdf("Go", T_dur=self.T_dur, dt=self.dt) if exp else x.cdf("Go")
-        cdf_interp = interpolate.interp1d(t_domain, cdf / cdf[-1])
+        # The normalized cdf is monotone, so all quantiles are inverted at once: find the first grid point where
+        # the cdf reaches each quantile and interpolate linearly from the previous one, which is the root of
+        # interp1d(t_domain, cdf) - quantile
+        cdf = cdf / cdf[-1]
+        quantiles = np.asarray(self.rt_quantiles)
+        idx = np.clip(np.searchsorted(cdf, quantiles, side="left"), 1, len(cdf) - 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = (quantiles - cdf[idx - 1]) / (cdf[idx] - cdf[idx - 1])
+        rt_quantile_values = t_domain[idx - 1] + weights * (t_domain[idx] - t_domain[idx - 1])
         # If the model produces very fast RTs, interpolated cdf(0) can be >0.1, then we cannot find root like usual
         # In this case, the corresponding rt quantile is half of the time step of cdf
-        rt_quantile_values = [optimize.root_scalar(lambda x: cdf_interp(x) - quantile, bracket=(0, t_domain[-1])).root
-                              if (cdf_interp(0) < quantile) else self.dt / 2
-                              for quantile in self.rt_quantiles]
-        return np.array(rt_quantile_values)
+        return np.where(cdf[0] < quantiles, rt_quantile_values, self.dt / 2)
 
+    @profiling.traced
     def loss(self, model):
         solutions = self.cache_by_conditions(model)
+        t_domain = model.t_domain()
         WLS = 0
-        for comb in self.sample.condition_combinations(required_conditions=self.required_conditions):
-            c = frozenset(comb.items())
-            # print(c)
-            comb_sample = self.sample.subset(**comb)
-            self.comb_rts = pd.DataFrame([[item[0], item[1]["subj_id"]] for item in comb_sample.items(choice="Go")],
-                                         columns=["RT", "subj_id"])
-
+        for c, summary in self.empirical_summaries.items():
             for choice in ["Go", "Stay"]:
-                WLS += 4 * (solutions[c].prob(choice=choice) - comb_sample.prob(choice=choice)) ** 2
+                model_prob = solutions[c].prob(choice=choice)
+                WLS += 4 * (model_prob - summary[choice].prob) ** 2
                 # Sometimes model's prob(choice) is very close to 0, then RT distribution is weird, in this case ignore RT
-                if ((solutions[c].prob(choice=choice) > 0.001) & (comb_sample.prob(choice=choice) > 0)):
-                    model_rt_q = self.get_rt_quantiles(solutions[c].cdf(choice=choice), model.t_domain(), exp=False)
-                    exp_rt_q = self.get_rt_quantiles(comb_sample.cdf(choice=choice, T_dur=self.T_dur, dt=self.dt), model.t_domain(), exp=True)
-                    WLS += np.dot((model_rt_q - exp_rt_q) ** 2, self.rt_q_weights) * comb_sample.prob(choice=choice)
+                if ((model_prob > 0.001) & (summary[choice].prob > 0)):
+                    model_rt_q = self.get_rt_quantiles(solutions[c].cdf(choice=choice), t_domain, exp=False)
+                    WLS += np.dot((model_rt_q - summary[choice].rt_quantiles) ** 2, self.rt_q_weights) * summary[choice].prob
         return WLS
 
 
@@ -48,6 +119,7 @@ class LossWLSVincent(LossWLS):
 
     def get_rt_quantiles(self, cdf, t_domain, exp=False):
         if exp:
+            # only called from setup, with comb_rts set to the Go RTs of the current condition
             vincentized_quantiles = (self.comb_rts.groupby("subj_id")
                                      .apply(lambda group: np.quantile(a=group.RT, q=self.rt_quantiles))).mean()
             return vincentized_quantiles
@@ -1,8 +1,11 @@
+import copy
+import functools
 import numpy as np
 import scipy.stats
 import scipy.interpolate
 import pyddm
 import utils
+import profiling
 
 
 def get_conditions():
@@ -17,26 +20,45 @@ def get_conditions():
              for a_duration in [1.0]])
 
 
+@functools.lru_cache(maxsize=4)
+def get_ndt_kernel(ndt_location, ndt_scale, dt, length):
+    # Gaussian non-decision time weights arranged as a (length x length) Toeplitz matrix, such that
+    # kernel @ density == np.convolve(weights, density, mode="full")[length:(2 * length)]
+    times = np.arange(-length, length) * dt
+    weights = scipy.stats.norm(scale=ndt_scale, loc=ndt_location).pdf(times)
+    if np.sum(weights) > 0:
+        weights /= np.sum(weights)  # Ensure it integrates to 1
+    kernel = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(weights[::-1], length)[length - 1::-1])
+    kernel.flags.writeable = False
+    return kernel
+
+
 class OverlayNonDecisionGaussian(pyddm.Overlay):
-    """ Courtesy of the pyddm cookbook """
+    """ Courtesy of the pyddm cookbook. The convolution kernel is cached per (ndt_location, ndt_scale, dt, length),
+    and the upper and lower densities are convolved together in one matrix product """
     name = "Add a Gaussian-distributed non-decision time"
     required_parameters = ["ndt_location", "ndt_scale"]
 
+    def convolve(self, densities, dt):
+        # densities is a (... x time) array, e.g. the upper and lower densities of a stack of solutions
+        densities = np.asarray(densities)
+        kernel = get_ndt_kernel(float(self.ndt_location), float(self.ndt_scale), dt, densities.shape[-1])
+        return (densities.reshape(-1, densities.shape[-1]) @ kernel.T).reshape(densities.shape)
+
+    @profiling.timer("overlay")
     def apply(self, solution):
-        # Extract components of the solution object for convenience
-        corr = solution.choice_upper
-        err = solution.choice_lower
-        dt = solution.model.dt
-        # Create the weights for different timepoints
-        times = np.asarray(list(range(-len(corr), len(corr)))) * dt
-        weights = scipy.stats.norm(scale=self.ndt_scale, loc=self.ndt_location).pdf(times)
-        if np.sum(weights) > 0:
-            weights /= np.sum(weights)  # Ensure it integrates to 1
-        newcorr = np.convolve(weights, corr, mode="full")[len(corr):(2 * len(corr))]
-        newerr = np.convolve(weights, err, mode="full")[len(corr):(2 * len(corr))]
+        newcorr, newerr = self.convolve([solution.choice_upper, solution.choice_lower], solution.model.dt)
         return pyddm.Solution(newcorr, newerr, solution.model,
                               solution.conditions, solution.undec)
 
+    @profiling.timer("overlay")
+    def apply_all(self, solutions):
+        # same as [self.apply(solution) for solution in solutions] for solutions of one model, but in a single pass
+        densities = self.convolve([[solution.choice_upper, solution.choice_lower] for solution in solutions],
+                                  solutions[0].model.dt)
+        return [pyddm.Solution(newcorr, newerr, solution.model, solution.conditions, solution.undec)
+                for solution, (newcorr, newerr) in zip(solutions, densities)]
+
 
 class BoundCollapsingTta(pyddm.models.Bound):
     name = "Bounds dynamically collapsing with TTA"
@@ -44,22 +66,22 @@ class BoundCollapsingTta(pyddm.models.Bound):
     required_conditions = ["tta_0", "d_0"]
 
     def get_bound(self, t, conditions, **kwargs):
-        f_tta, f_d, f_a = self.state_interpolators[str(conditions)]
-        tta = f_tta(t)
+        return self.get_bound_from_states(*get_states(self.state_interpolators, t, conditions))
+
+    def get_bound_from_states(self, tta, d, a, tta_dot):
         return self.b_0 / (1 + np.exp(-self.k * (tta - self.tta_crit)))
 
 
 class BoundCollapsingGeneralizedGap(pyddm.models.Bound):
     name = "Bounds dynamically collapsing with the generalized gap"
-    required_parameters = ["b_0", "k", "alpha", "beta_d", "beta_a", "theta"]
+    required_parameters = ["b_0", "k", "alpha", "beta_d", "beta_a", "theta", "state_interpolators"]
     required_conditions = ["tta_0", "d_0"]
     beta_tta = 1.0
 
     def get_bound(self, t, conditions, **kwargs):
-        f_tta, f_d, f_a = self.state_interpolators[str(conditions)]
-        tta = f_tta(t)
-        d = f_d(t)
-        a = f_a(t)
+        return self.get_bound_from_states(*get_states(self.state_interpolators, t, conditions))
+
+    def get_bound_from_states(self, tta, d, a, tta_dot):
         return self.b_0 / (1 + np.exp(-self.k * (self.beta_tta * tta + self.beta_d * d - self.beta_a * a - self.theta)))
 
 
@@ -71,10 +93,10 @@ class DriftAccelerationDependent(pyddm.models.Drift):
     beta_tta = 1.0
 
     def get_drift(self, t, conditions, **kwargs):
-        f_tta, f_d, f_a, f_tta_dot = self.state_interpolators[str(conditions)]
-        tta = f_tta(t)
-        d = f_d(t)
-        a = f_a(t)
+        return self.get_drift_from_states(*get_states(self.state_interpolators, t, conditions))
+
+    def get_drift_from_states(self, tta, d, a, tta_dot):
+        # also works on whole (condition x time) arrays of states, see solver.py
         return self.alpha * (self.beta_tta * tta + self.beta_d * d - self.beta_a * a - self.theta)
 
 
@@ -89,30 +111,103 @@ class DriftTTADotDependent(pyddm.models.Drift):
     beta_tta = 1.0
 
     def get_drift(self, t, conditions, **kwargs):
-        f_tta, f_d, f_a, f_tta_dot = self.state_interpolators[str(conditions)]
-        tta = f_tta(t)
-        d = f_d(t)
-        f_tta_dot = f_tta_dot(t)
-        return self.alpha * (self.beta_tta * tta + self.beta_d * d + self.beta_a * f_tta_dot - self.theta)
+        return self.get_drift_from_states(*get_states(self.state_interpolators, t, conditions))
+
+    def get_drift_from_states(self, tta, d, a, tta_dot):
+        return self.alpha * (self.beta_tta * tta + self.beta_d * d + self.beta_a * tta_dot - self.theta)
+
+
+def get_condition_key(condition):
+    # hashable identifier of a condition; unlike str(condition) it does not depend on the dict order or number formatting
+    return condition["tta_0"], condition["d_0"], tuple(condition["a_values"]), condition["a_duration"]
+
+
+class StateTable:
+    """ tta(t), d(t), a(t) and tta_dot(t) of all conditions evaluated once on the dt grid of the model.
+    Drift and bound look the states up by integer condition id and time index instead of interpolating them
+    on every solver timestep """
+
+    def __init__(self, conditions, T_dur, dt):
+        self.T_dur = T_dur
+        self.dt = dt
+        # same grid as pyddm.Model.t_domain()
+        self.t_domain = np.arange(0., T_dur + 0.1 * dt, dt)
+        self.condition_ids = {get_condition_key(condition): condition_id
+                              for condition_id, condition in enumerate(conditions)}
+
+        states = get_kinematics(tta_0=[condition["tta_0"] for condition in conditions],
+                                d_0=[condition["d_0"] for condition in conditions],
+                                a_values=[condition["a_values"] for condition in conditions],
+                                a_duration=[condition["a_duration"] for condition in conditions],
+                                T_dur=T_dur, t=np.minimum(self.t_domain, T_dur))
+        # states[i, j, k] is the i-th state variable (tta, d, a, tta_dot) in the j-th condition at t_domain[k]
+        self.states = np.ascontiguousarray(states[:4])
+        self.states.flags.writeable = False
+
+    def __deepcopy__(self, memo):
+        # the table is read-only, so all copies of a model (e.g. in pyddm's fitting routines) can share it
+        return self
+
+    def __repr__(self):
+        return "StateTable(n_conditions=%i, T_dur=%s, dt=%s)" % (len(self.condition_ids), self.T_dur, self.dt)
+
+    def get_condition_id(self, conditions):
+        return self.condition_ids[get_condition_key(conditions)]
+
+    def get_states(self, t, conditions):
+        condition_states = self.states[:, self.get_condition_id(conditions)]
+        t_idx = int(round(t / self.dt))
+        if (0 <= t_idx < len(self.t_domain)) and (abs(t_idx * self.dt - t) < 1e-9):
+            return condition_states[:, t_idx]
+        # off-grid time points (e.g. the Runge-Kutta substeps of Model.simulate_trial) are interpolated linearly
+        return [np.interp(t, self.t_domain, state) for state in condition_states]
+
+
+def get_states(state_interpolators, t, conditions):
+    # state_interpolators is either a StateTable or a dict of interpolators as returned by get_state_interpolators
+    if isinstance(state_interpolators, StateTable):
+        return state_interpolators.get_states(t, conditions)
+    return [f(t) for f in state_interpolators[str(conditions)]]
+
 
+def get_conditions_key(conditions):
+    return tuple(get_condition_key(condition) for condition in conditions)
 
-def get_state_interpolators(conditions, T_dur):
+
+@functools.lru_cache(maxsize=16)
+def get_state_table(conditions_key, T_dur, dt):
+    # one shared StateTable per (condition set, T_dur, dt) in the process
+    conditions = [{"tta_0": tta_0, "d_0": d_0, "a_values": a_values, "a_duration": a_duration}
+                  for tta_0, d_0, a_values, a_duration in conditions_key]
+    return StateTable(conditions, T_dur, dt)
+
+
+def get_state_interpolators(conditions, T_dur, dt=None):
+    # if dt is given, the states are tabulated on the dt grid, otherwise a dict of interpolators is returned
+    if dt is not None:
+        return get_state_table(get_conditions_key(conditions), T_dur, dt)
     interpolators = [get_state_interpolators_per_condition(condition, T_dur) for condition in conditions]
     return {str(condition): interpolator for condition, interpolator in zip(conditions, interpolators)}
 
 
-def get_state_interpolators_per_condition(condition, T_dur):
-    d_0 = condition["d_0"]
-    tta_0 = condition["tta_0"]
-    a_values = condition["a_values"]
-    a_duration = condition["a_duration"]
+def get_breakpoint_states(tta_0, d_0, a_values, a_duration, T_dur):
+    """ Piecewise bot trajectories of many conditions at once. tta_0, d_0 and a_duration are 1-D arrays,
+    a_values is a (condition x 4) array. Returns (condition x breakpoint) arrays of the breakpoint times and of
+    a, v, d and tta at these breakpoints """
+    tta_0 = np.asarray(tta_0, dtype=float)
+    d_0 = np.asarray(d_0, dtype=float)
+    a_duration = np.asarray(a_duration, dtype=float)
+    a_values = np.asarray(a_values, dtype=float).reshape(len(tta_0), -1)
 
-    breakpoints = np.array([0., 0.25, (0.25 + a_duration), min(0.25 + a_duration * 2, T_dur)] + [T_dur])
+    breakpoints = np.stack([np.zeros_like(a_duration), np.full_like(a_duration, 0.25), (0.25 + a_duration),
+                            np.minimum(0.25 + a_duration * 2, T_dur), np.full_like(a_duration, T_dur)], axis=1)
 
-    v_0 = d_0 / tta_0
-    a_values = np.concatenate([a_values, [0.]])
-    v_values = np.concatenate([[v_0], v_0 + np.cumsum(np.diff(breakpoints) * a_values[:-1])])
-    d_values = np.concatenate([[d_0], d_0 - np.cumsum(np.diff(breakpoints) * (v_values[1:] + v_values[:-1]) / 2)])
+    v_0 = (d_0 / tta_0)[:, None]
+    a_values = np.concatenate([a_values, np.zeros((len(a_values), 1))], axis=1)
+    v_values = np.concatenate([v_0, v_0 + np.cumsum(np.diff(breakpoints, axis=1) * a_values[:, :-1], axis=1)], axis=1)
+    d_values = np.concatenate([d_0[:, None], d_0[:, None] - np.cumsum(np.diff(breakpoints, axis=1)
+                                                                      * (v_values[:, 1:] + v_values[:, :-1]) / 2, axis=1)],
+                              axis=1)
 
     tta_values = d_values / v_values
     # if at some point the oncoming vehicle starts moving away from the intersection, tta goes negative
@@ -120,6 +215,48 @@ def get_state_interpolators_per_condition(condition, T_dur):
     v_threshold = 1
     tta_values[v_values < v_threshold] = d_values[v_values < v_threshold] / v_threshold
 
+    return breakpoints, a_values, v_values, d_values, tta_values
+
+
+def interpolate_linear(t, x, y):
+    # row-wise equivalent of interp1d(x[i], y[i], kind=1)(t) for 2-D x and y (or 1-D x shared by all rows of y)
+    slopes = np.diff(y, axis=1) / np.diff(x, axis=-1)
+    if np.ndim(x) == 1:
+        idx = np.clip(np.searchsorted(x, t), 1, len(x) - 1) - 1
+        return slopes[:, idx] * (t - x[idx]) + y[:, idx]
+    idx = np.clip(np.sum(x[:, :, None] < t, axis=1), 1, x.shape[1] - 1) - 1
+    return (np.take_along_axis(slopes, idx, axis=1) * (t - np.take_along_axis(x, idx, axis=1))
+            + np.take_along_axis(y, idx, axis=1))
+
+
+def get_kinematics(tta_0, d_0, a_values, a_duration, T_dur, t):
+    """ Vectorized counterpart of get_state_interpolators_per_condition: evaluates the bot trajectories of all
+    conditions at time points t in one pass. Returns (condition x time) arrays tta, d, a, tta_dot and v """
+    t = np.asarray(t, dtype=float)
+    breakpoints, a_values, v_values, d_values, tta_values = get_breakpoint_states(tta_0, d_0, a_values, a_duration, T_dur)
+
+    # acceleration is piecewise-constant (right-continuous, like interp1d with kind=0)
+    a = np.take_along_axis(a_values, np.sum(breakpoints[:, 1:, None] <= t, axis=1), axis=1)
+    # under piecewise-constant acceleration, v and tta is piecewise-linear
+    v = interpolate_linear(t, breakpoints, v_values)
+    tta = interpolate_linear(t, breakpoints, tta_values)
+    # under piecewise-linear v, d is piecewise-quadratic, but piecewise-linear approximation is very close in our case
+    d = interpolate_linear(t, breakpoints, d_values)
+
+    # tta dot is not piecewise-linear, so it is estimated at a larger number of time points and then interpolated
+    t_values = np.linspace(start=0, stop=T_dur, num=51)
+    tta_dot_values = utils.get_derivative(t_values, interpolate_linear(t_values, breakpoints, tta_values))
+    tta_dot = interpolate_linear(t, t_values, tta_dot_values)
+
+    return tta, d, a, tta_dot, v
+
+
+def get_state_interpolators_per_condition(condition, T_dur):
+    breakpoints, a_values, v_values, d_values, tta_values = (
+        values[0] for values in get_breakpoint_states(tta_0=[condition["tta_0"]], d_0=[condition["d_0"]],
+                                                      a_values=[condition["a_values"]],
+                                                      a_duration=[condition["a_duration"]], T_dur=T_dur))
+
     # acceleration is piecewise-constant
     f_a = scipy.interpolate.interp1d(breakpoints, a_values, kind=0)
     # under piecewise-constant acceleration, v and tta is piecewise-linear
@@ -136,99 +273,95 @@ def get_state_interpolators_per_condition(condition, T_dur):
     return f_tta, f_d, f_a, f_tta_dot
 
 
-def get_model_components(state_interpolators):
-    overlay_uniform = pyddm.OverlayNonDecisionUniform(nondectime=pyddm.Fittable(minval=0, maxval=2.0),
-                                                      halfwidth=pyddm.Fittable(minval=0.001, maxval=0.5))
-    overlay_gaussian = OverlayNonDecisionGaussian(ndt_location=pyddm.Fittable(minval=0, maxval=2.0),
-                                                  ndt_scale=pyddm.Fittable(minval=0.001, maxval=0.5))
-
-    drift_no_acceleration = DriftAccelerationDependent(alpha=pyddm.Fittable(minval=0.0, maxval=5.0),
-                                                       beta_d=pyddm.Fittable(minval=0.0, maxval=1.0),
-                                                       beta_a=0,
-                                                       theta=pyddm.Fittable(minval=0, maxval=20),
-                                                       state_interpolators=state_interpolators)
-
-    drift_with_acceleration = DriftAccelerationDependent(alpha=pyddm.Fittable(minval=0.0, maxval=5.0),
-                                                         beta_d=pyddm.Fittable(minval=0.0, maxval=1.0),
-                                                         beta_a=pyddm.Fittable(minval=0.0, maxval=10.0),
-                                                         theta=pyddm.Fittable(minval=0, maxval=20),
-                                                         state_interpolators=state_interpolators)
-
-    drift_with_tta_dot = DriftTTADotDependent(alpha=pyddm.Fittable(minval=0.0, maxval=5.0),
-                                              beta_d=pyddm.Fittable(minval=0.0, maxval=1.0),
-                                              beta_a=pyddm.Fittable(minval=0.0, maxval=10.0),
-                                              theta=pyddm.Fittable(minval=0, maxval=20),
-                                              state_interpolators=state_interpolators)
-
-    bound_constant = pyddm.BoundConstant(B=pyddm.Fittable(minval=0.1, maxval=5.0))
-
-    bound_collapsing_tta = BoundCollapsingTta(b_0=pyddm.Fittable(minval=0.5, maxval=5.0),
-                                              k=pyddm.Fittable(minval=0.0, maxval=2.0),
-                                              tta_crit=pyddm.Fittable(minval=2.0, maxval=10.0),
-                                              state_interpolators=state_interpolators)
-
-    IC_zero = pyddm.ICPointRatio(x0=0)
-
-    IC_point_ratio = pyddm.ICPointRatio(x0=pyddm.Fittable(minval=-1.0, maxval=1.0))
-
-    return overlay_gaussian, overlay_uniform, drift_no_acceleration, drift_with_acceleration, drift_with_tta_dot, bound_constant, bound_collapsing_tta, IC_zero, IC_point_ratio
-
-
-def get_model(model_no, T_dur):
-    state_interpolators = get_state_interpolators(get_conditions(), T_dur)
-    (overlay_gaussian, overlay_uniform,
-     drift_no_acceleration, drift_with_acceleration, drift_with_tta_dot,
-     bound_constant, bound_collapsing_tta,
-     IC_zero, IC_point_ratio) = get_model_components(state_interpolators=state_interpolators)
-
-    overlay = overlay_gaussian
-
-    if model_no == 1:
-        drift = drift_no_acceleration
-        bound = bound_constant
-        IC = IC_zero
-    elif model_no == 2:
-        drift = drift_no_acceleration
-        bound = bound_constant
-        IC = IC_point_ratio
-    elif model_no == 3:
-        drift = drift_no_acceleration
-        bound = bound_collapsing_tta
-        IC = IC_zero
-    elif model_no == 4:
-        drift = drift_no_acceleration
-        bound = bound_collapsing_tta
-        IC = IC_point_ratio
-    elif model_no == 5:
-        drift = drift_with_acceleration
-        bound = bound_constant
-        IC = IC_zero
-    elif model_no == 6:
-        drift = drift_with_acceleration
-        bound = bound_constant
-        IC = IC_point_ratio
-    elif model_no == 7:
-        drift = drift_with_acceleration
-        bound = bound_collapsing_tta
-        IC = IC_zero
-    elif model_no == 8:
-        drift = drift_with_acceleration
-        bound = bound_collapsing_tta
-        IC = IC_point_ratio
-
-    # these two models can be fitted to check NDT assumptions and tta_dot/a comparison
-    # elif model_no == 9:
-    #     # Model 2 but with uniform NDT
-    #     drift = drift_no_acceleration
-    #     bound = bound_constant
-    #     IC = IC_point_ratio
-    #     overlay = overlay_uniform
-    # elif model_no == 10:
-    #     # Model 6 but with tta_dot instead of a in the acceleration term
-    #     drift = drift_with_tta_dot
-    #     bound = bound_constant
-    #     IC = IC_point_ratio
+def get_model_component_factories(state_interpolators):
+    # components are only instantiated when a model uses them
+    return {
+        "overlay_gaussian": lambda: OverlayNonDecisionGaussian(ndt_location=pyddm.Fittable(minval=0, maxval=2.0),
+                                                               ndt_scale=pyddm.Fittable(minval=0.001, maxval=0.5)),
+        "overlay_uniform": lambda: pyddm.OverlayNonDecisionUniform(nondectime=pyddm.Fittable(minval=0, maxval=2.0),
+                                                                   halfwidth=pyddm.Fittable(minval=0.001, maxval=0.5)),
+        "drift_no_acceleration": lambda: DriftAccelerationDependent(alpha=pyddm.Fittable(minval=0.0, maxval=5.0),
+                                                                    beta_d=pyddm.Fittable(minval=0.0, maxval=1.0),
+                                                                    beta_a=0,
+                                                                    theta=pyddm.Fittable(minval=0, maxval=20),
+                                                                    state_interpolators=state_interpolators),
+        "drift_with_acceleration": lambda: DriftAccelerationDependent(alpha=pyddm.Fittable(minval=0.0, maxval=5.0),
+                                                                      beta_d=pyddm.Fittable(minval=0.0, maxval=1.0),
+                                                                      beta_a=pyddm.Fittable(minval=0.0, maxval=10.0),
+                                                                      theta=pyddm.Fittable(minval=0, maxval=20),
+                                                                      state_interpolators=state_interpolators),
+        "drift_with_tta_dot": lambda: DriftTTADotDependent(alpha=pyddm.Fittable(minval=0.0, maxval=5.0),
+                                                           beta_d=pyddm.Fittable(minval=0.0, maxval=1.0),
+                                                           beta_a=pyddm.Fittable(minval=0.0, maxval=10.0),
+                                                           theta=pyddm.Fittable(minval=0, maxval=20),
+                                                           state_interpolators=state_interpolators),
+        "bound_constant": lambda: pyddm.BoundConstant(B=pyddm.Fittable(minval=0.1, maxval=5.0)),
+        "bound_collapsing_tta": lambda: BoundCollapsingTta(b_0=pyddm.Fittable(minval=0.5, maxval=5.0),
+                                                           k=pyddm.Fittable(minval=0.0, maxval=2.0),
+                                                           tta_crit=pyddm.Fittable(minval=2.0, maxval=10.0),
+                                                           state_interpolators=state_interpolators),
+        "IC_zero": lambda: pyddm.ICPointRatio(x0=0),
+        "IC_point_ratio": lambda: pyddm.ICPointRatio(x0=pyddm.Fittable(minval=-1.0, maxval=1.0)),
+    }
 
+
+def get_model_components(state_interpolators):
+    factories = get_model_component_factories(state_interpolators)
+    return tuple(factories[name]() for name in ["overlay_gaussian", "overlay_uniform",
+                                                "drift_no_acceleration", "drift_with_acceleration",
+                                                "drift_with_tta_dot", "bound_constant", "bound_collapsing_tta",
+                                                "IC_zero", "IC_point_ratio"])
+
+
+# (drift, bound, IC, overlay) of each model
+MODEL_COMPONENTS = {1: ("drift_no_acceleration", "bound_constant", "IC_zero", "overlay_gaussian"),
+                    2: ("drift_no_acceleration", "bound_constant", "IC_point_ratio", "overlay_gaussian"),
+                    3: ("drift_no_acceleration", "bound_collapsing_tta", "IC_zero", "overlay_gaussian"),
+                    4: ("drift_no_acceleration", "bound_collapsing_tta", "IC_point_ratio", "overlay_gaussian"),
+                    5: ("drift_with_acceleration", "bound_constant", "IC_zero", "overlay_gaussian"),
+                    6: ("drift_with_acceleration", "bound_constant", "IC_point_ratio", "overlay_gaussian"),
+                    7: ("drift_with_acceleration", "bound_collapsing_tta", "IC_zero", "overlay_gaussian"),
+                    8: ("drift_with_acceleration", "bound_collapsing_tta", "IC_point_ratio", "overlay_gaussian"),
+                    # these two models can be fitted to check NDT assumptions and tta_dot/a comparison
+                    # Model 2 but with uniform NDT
+                    # 9: ("drift_no_acceleration", "bound_constant", "IC_point_ratio", "overlay_uniform"),
+                    # Model 6 but with tta_dot instead of a in the acceleration term
+                    # 10: ("drift_with_tta_dot", "bound_constant", "IC_point_ratio", "overlay_gaussian"),
+                    }
+
+
+@functools.lru_cache(maxsize=64)
+def get_model_template(model_no, T_dur, conditions_key, dt, dx):
+    state_interpolators = get_state_table(conditions_key, T_dur, dt)
+    factories = get_model_component_factories(state_interpolators)
+    drift, bound, IC, overlay = (factories[name]() for name in MODEL_COMPONENTS[model_no])
     return (pyddm.Model(name="Model %i" % model_no, choice_names=("Go", "Stay"),
                         drift=drift, bound=bound, IC=IC, overlay=overlay,
-                        noise=pyddm.NoiseConstant(noise=1), T_dur=T_dur))
+                        noise=pyddm.NoiseConstant(noise=1), T_dur=T_dur, dt=dt, dx=dx))
+
+
+def get_model(model_no, T_dur, dt=0.005, dx=0.005, conditions=None):
+    """ Models are built once per (model_no, T_dur, condition set, dt, dx) and then copied, so that setting
+    the parameters of the returned model does not affect other calls. All copies share the same StateTable.
+    By default, the model covers the experimental conditions of get_conditions() """
+    if conditions is None:
+        conditions = get_conditions()
+    return copy.deepcopy(get_model_template(model_no, T_dur, get_conditions_key(conditions), dt, dx))
+
+
+def get_nested_parameters(model, parameters):
+    """ Parameters of model, in the order of model.get_model_parameter_names(), from a dict of the named parameters
+    of another model, e.g. a row of a stored subj_*_parameters_fitted.csv. Parameters the other model does not have
+    take the value at which it is nested in this model (beta_a = 0, x0 = 0, or a collapsing bound with k = 0).
+    Parameters this model does not have are dropped, so coming from a more general model only approximates the fit """
+    parameters = dict(parameters)
+    if "B" not in parameters and "b_0" in parameters:
+        # the collapsing bound at tta = tta_crit
+        parameters["B"] = parameters["b_0"] / 2
+    if "b_0" not in parameters and "B" in parameters:
+        # with k = 0, the collapsing bound is constant at b_0 / 2, whatever tta_crit is
+        parameters.update(b_0=2 * parameters["B"], k=0.)
+    parameters = dict({"beta_a": 0., "x0": 0.}, **parameters)
+    # anything else that is missing starts in the middle of its range
+    return [float(parameters[name]) if name in parameters else (fittable.minval + fittable.maxval) / 2
+            for name, fittable in zip(model.get_model_parameter_names(), model.get_model_parameters())]
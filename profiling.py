@@ -0,0 +1,106 @@
+"""
+profiling.py
+Fit-time instrumentation. While a Trace is active, every loss evaluation of the loss functions in loss_functions.py is
+recorded with the model parameters, the loss value, and the time spent in each stage: evaluating drift and bound
+(drift_bound), solving the model (solver), applying the non-decision time (overlay), and the rest of the loss
+function code (loss). Stage times are exclusive, e.g. the solver time does not include the
+drift and bound evaluation it triggers. Records are written to a JSON lines file, one line per loss evaluation.
+Evaluations in other processes (e.g. the workers of fitting.PopulationLoss) are not recorded
+"""
+
+import json
+import time
+import functools
+import contextlib
+import pandas as pd
+
+STAGES = ["drift_bound", "solver", "overlay", "loss"]
+
+# the Trace that records loss evaluations in this process, if any
+active_trace = None
+
+
+class Trace:
+    """ Context manager that records all loss evaluations in file_name. run_info (e.g. model_no, subj_id) is added
+    to every record """
+
+    def __init__(self, file_name, **run_info):
+        self.file_name = file_name
+        self.run_info = run_info
+        self.file = None
+        # record of the loss evaluation in progress, and the time spent in nested timers of each open timer
+        self.evaluation = None
+        self.nested_times = []
+
+    def __enter__(self):
+        global active_trace
+        if active_trace is not None:
+            raise RuntimeError("Another trace is already active")
+        self.file = open(self.file_name, "w")
+        active_trace = self
+        return self
+
+    def __exit__(self, *args):
+        global active_trace
+        active_trace = None
+        self.file.close()
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def timer(stage):
+    # adds the time spent in the block, minus that of nested timers, to the stage of the current evaluation
+    trace = active_trace
+    if trace is None or trace.evaluation is None:
+        yield
+        return
+    trace.nested_times.append(0.)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        trace.evaluation["time_" + stage] += elapsed - trace.nested_times.pop()
+        if trace.nested_times:
+            trace.nested_times[-1] += elapsed
+
+
+def traced(loss):
+    """ Decorator for the loss method of a pyddm.LossFunction, recording each call as one loss evaluation """
+    @functools.wraps(loss)
+    def traced_loss(self, model):
+        trace = active_trace
+        # a loss that calls another traced loss is recorded once
+        if trace is None or trace.evaluation is not None:
+            return loss(self, model)
+        trace.evaluation = dict(trace.run_info, model=model.name, loss_function=type(self).__name__,
+                                parameters=dict(zip(model.get_model_parameter_names(),
+                                                    [float(parameter) for parameter in model.get_model_parameters()])),
+                                **{"time_" + stage: 0. for stage in STAGES})
+        try:
+            with timer("loss"):
+                value = loss(self, model)
+        finally:
+            record, trace.evaluation = trace.evaluation, None
+        record["loss"] = float(value)
+        record["time_total"] = sum(record["time_" + stage] for stage in STAGES)
+        trace.write(record)
+        return value
+    return traced_loss
+
+
+def read_traces(file_names):
+    return pd.concat([pd.read_json(file_name, lines=True) for file_name in file_names], ignore_index=True)
+
+
+def get_summary(traces, by="model"):
+    """ Number of loss evaluations and the mean time per evaluation (in ms) of each stage, per value of by (a column or
+    list of columns of the traces, e.g. model or ["model", "loss_function"]), to compare the cost of the models """
+    columns = ["time_" + stage for stage in STAGES] + ["time_total"]
+    summary = traces.groupby(by)[columns].mean() * 1000
+    summary.columns = [column.replace("time_", "") + "_ms" for column in columns]
+    summary.insert(0, "n_evaluations", traces.groupby(by).size())
+    summary["solver_share"] = summary.solver_ms / summary.total_ms
+    return summary
@@ -0,0 +1,174 @@
+"""
+results_store.py
+SQLite store of the modeling results: fitted parameters and losses, simulated measures, and RT distributions, indexed
+by model, loss, subject, and condition. The database is in WAL mode, so that many processes (e.g. the workers of
+fit_runner.py) can write at once while others read: every write is one short transaction, and a writer waits up to
+timeout seconds for another one to finish. Queries return pandas DataFrames with a_values as tuples
+"""
+
+import os
+import ast
+import json
+import sqlite3
+import contextlib
+from datetime import datetime
+import pandas as pd
+
+DEFAULT_PATH = "modeling/results.sqlite"
+
+CONDITION_COLUMNS = ["tta_0", "d_0", "a_values", "a_duration"]
+# columns of each table besides id and created
+TABLE_COLUMNS = {"fits": ["loss_name", "model_no", "subj_id", "loss", "parameters", "n_evaluations"],
+                 "sim_measures": ["loss_name", "model_no", "subj_id", "kind"] + CONDITION_COLUMNS
+                                 + ["is_go_decision", "RT_go", "RT_stay"],
+                 "rt_distributions": ["loss_name", "model_no", "subj_id", "kind"] + CONDITION_COLUMNS
+                                     + ["t", "rt_go_distr", "rt_stay_distr"]}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY, loss_name TEXT NOT NULL, model_no INTEGER NOT NULL, subj_id TEXT NOT NULL, loss REAL,
+    parameters TEXT NOT NULL, n_evaluations INTEGER, created TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS fits_model ON fits (model_no, loss_name, subj_id);
+CREATE INDEX IF NOT EXISTS fits_subject ON fits (subj_id);
+
+CREATE TABLE IF NOT EXISTS sim_measures (
+    id INTEGER PRIMARY KEY, loss_name TEXT NOT NULL, model_no INTEGER NOT NULL, subj_id TEXT NOT NULL,
+    kind TEXT NOT NULL, tta_0 REAL, d_0 REAL, a_values TEXT, a_duration REAL,
+    is_go_decision REAL, RT_go REAL, RT_stay REAL, created TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS sim_measures_model ON sim_measures (model_no, loss_name, subj_id, kind);
+CREATE INDEX IF NOT EXISTS sim_measures_condition ON sim_measures (tta_0, d_0, a_values, a_duration);
+
+CREATE TABLE IF NOT EXISTS rt_distributions (
+    id INTEGER PRIMARY KEY, loss_name TEXT NOT NULL, model_no INTEGER NOT NULL, subj_id TEXT NOT NULL,
+    kind TEXT NOT NULL, tta_0 REAL, d_0 REAL, a_values TEXT, a_duration REAL,
+    t REAL, rt_go_distr REAL, rt_stay_distr REAL, created TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS rt_distributions_model ON rt_distributions (model_no, loss_name, subj_id, kind);
+CREATE INDEX IF NOT EXISTS rt_distributions_condition ON rt_distributions (tta_0, d_0, a_values, a_duration);
+"""
+
+
+def get_a_values_key(a_values):
+    # one text representation per acceleration profile, e.g. "(0.0, -4.0, 4.0, 0.0)", also for a_values read from
+    # csv files as strings
+    if isinstance(a_values, str):
+        a_values = ast.literal_eval(a_values)
+    return str(tuple(float(a) for a in a_values))
+
+
+class ResultsStore:
+    def __init__(self, path=DEFAULT_PATH, timeout=60.):
+        self.path = path
+        self.timeout = timeout
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.transaction() as connection:
+            connection.executescript(SCHEMA)
+
+    def __repr__(self):
+        return "ResultsStore(%s)" % self.path
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # a connection per transaction, so that a store can be shared by threads and passed to other processes
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def insert(self, table, rows):
+        """ Adds rows (a DataFrame, or a list of dicts) with the columns of TABLE_COLUMNS[table] to table """
+        columns = TABLE_COLUMNS[table]
+        rows = pd.DataFrame(rows)
+        if "a_values" in columns:
+            rows["a_values"] = rows.a_values.map(get_a_values_key)
+        # plain Python values (sqlite3 does not accept numpy scalars), with None for missing values
+        values = rows[columns].astype(object).where(rows[columns].notna(), None).values.tolist()
+        created = datetime.now().isoformat(timespec="seconds")
+        with self.transaction() as connection:
+            connection.executemany("INSERT INTO %s (%s, created) VALUES (%s)"
+                                   % (table, ", ".join(columns), ", ".join(["?"] * (len(columns) + 1))),
+                                   [row + [created] for row in values])
+
+    def add_fit(self, loss_name, model_no, subj_id, loss, parameters, n_evaluations=None):
+        # parameters is a dict of the fitted parameters by name, which differ between models
+        self.insert("fits", [{"loss_name": loss_name, "model_no": int(model_no), "subj_id": str(subj_id),
+                              "loss": float(loss), "parameters": json.dumps({name: float(value) for name, value
+                                                                            in parameters.items()}),
+                              "n_evaluations": n_evaluations}])
+
+    def add_sim_measures(self, loss_name, model_no, measures, kind="fitted"):
+        # measures as returned by simulate_model in 03_simulate_fitted_models.ipynb, or by sweep.run_sweep;
+        # kind distinguishes e.g. the fitted conditions ("fitted") from the nudge predictions ("prediction")
+        self.insert("sim_measures", pd.DataFrame(measures).assign(loss_name=loss_name, model_no=int(model_no),
+                                                                  subj_id=lambda df: df.subj_id.astype(str),
+                                                                  kind=kind))
+
+    def add_rt_distributions(self, loss_name, model_no, distributions, kind="pdf"):
+        self.insert("rt_distributions", pd.DataFrame(distributions).assign(loss_name=loss_name,
+                                                                           model_no=int(model_no),
+                                                                           subj_id=lambda df: df.subj_id.astype(str),
+                                                                           kind=kind))
+
+    def query(self, sql, parameters=()):
+        """ Result of any query as a DataFrame, e.g. store.query("SELECT * FROM fits WHERE model_no = ?", [2]) """
+        with self.transaction() as connection:
+            result = pd.read_sql_query(sql, connection, params=parameters)
+        if "a_values" in result:
+            # each distinct profile is parsed only once
+            a_values = {key: ast.literal_eval(key) for key in result.a_values.dropna().unique()}
+            result["a_values"] = result.a_values.map(a_values)
+        return result
+
+    def select(self, table, condition=None, **filters):
+        # rows of table that match all filters (column=value, None matches anything) and the condition
+        # (a dict of CONDITION_COLUMNS values)
+        filters = dict(filters, **(condition or {}))
+        if "a_values" in filters:
+            filters["a_values"] = get_a_values_key(filters["a_values"])
+        filters = {column: value for column, value in filters.items() if value is not None}
+        where = " AND ".join("%s = ?" % column for column in filters)
+        return self.query("SELECT * FROM %s%s ORDER BY id" % (table, " WHERE " + where if where else ""),
+                          [str(value) if column == "subj_id" else value for column, value in filters.items()])
+
+    def get_fits(self, loss_name=None, model_no=None, subj_id=None, latest=True):
+        """ Fitted parameters with one column per parameter, as in subj_*_parameters_fitted.csv. With latest, only the
+        most recent fit of each (loss_name, model_no, subj_id) """
+        fits = self.select("fits", loss_name=loss_name, model_no=model_no, subj_id=subj_id)
+        if latest:
+            fits = fits.groupby(["loss_name", "model_no", "subj_id"], sort=False).tail(1)
+        parameters = pd.DataFrame([json.loads(p) for p in fits.parameters], index=fits.index)
+        return pd.concat([fits.drop(columns="parameters"), parameters], axis=1).reset_index(drop=True)
+
+    def get_sim_measures(self, loss_name=None, model_no=None, subj_id=None, kind=None, condition=None):
+        return self.select("sim_measures", condition=condition, loss_name=loss_name, model_no=model_no,
+                           subj_id=subj_id, kind=kind)
+
+    def get_rt_distributions(self, loss_name=None, model_no=None, subj_id=None, kind=None, condition=None):
+        return self.select("rt_distributions", condition=condition, loss_name=loss_name, model_no=model_no,
+                           subj_id=subj_id, kind=kind)
+
+
+def import_csv_results(store, root="modeling"):
+    """ Adds the results in the csv files of root/fit_results_<loss_name>/model_<model_no> to the store """
+    for results_dir in sorted(os.listdir(root)):
+        if not results_dir.startswith("fit_results_"):
+            continue
+        loss_name = results_dir[len("fit_results_"):]
+        for model_dir in sorted(os.listdir(os.path.join(root, results_dir))):
+            model_no = int(model_dir[len("model_"):])
+            path = os.path.join(root, results_dir, model_dir)
+            for file_name in sorted(os.listdir(path)):
+                if not file_name.endswith(".csv"):
+                    continue
+                results = pd.read_csv(os.path.join(path, file_name))
+                if file_name.endswith("_parameters_fitted.csv"):
+                    for fit in results.to_dict(orient="records"):
+                        store.add_fit(loss_name, model_no, fit.pop("subj_id"), fit.pop("loss"), fit)
+                elif file_name.endswith("_sim_measures.csv"):
+                    store.add_sim_measures(loss_name, model_no, results,
+                                           kind="prediction" if file_name.startswith("prediction_") else "fitted")
+                elif "_sim_rt_" in file_name:
+                    store.add_rt_distributions(loss_name, model_no, results, kind=file_name[-7:-4])
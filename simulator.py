@@ -0,0 +1,145 @@
+"""
+simulator.py
+Monte Carlo simulation of single trials from the models built by models.get_model.
+All trials of all conditions are advanced together with the Euler-Maruyama scheme on the model's dt grid, using the
+model's drift, bound, noise, IC, and non-decision time overlay. The output has the column layout of data/measures.csv
+"""
+
+import numpy as np
+import pandas as pd
+import pyddm
+import models
+import solver
+
+# columns of data/measures.csv as written by 00_preprocess_data.py (the first four make up the index)
+MEASURES_INDEX = ["subj_id", "session", "route", "intersection_no"]
+MEASURES_COLUMNS = ["idx_bot_visible", "idx_response", "idx_yield", "idx_min_distance", "min_distance",
+                    "gap_to_truck", "RT_gas", "RT_yield", "is_negative_rating", "is_go_decision",
+                    "tta_0", "d_0", "a_values", "a_duration", "decision", "RT"]
+
+
+def get_drift_bound_noise(model, conditions):
+    # (condition x time) arrays of drift, bound, and noise. The models in models.py do not depend on the
+    # decision variable x, so these are evaluated once per condition and timestep
+    if solver.can_solve_batched(model):
+        drift, bound = solver.get_drift_and_bound(model, conditions)
+        noise = np.full(drift.shape, float(model.get_dependence("noise").noise))
+        return drift, bound, noise
+    t_domain = model.t_domain()
+    drift = np.array([[model.get_dependence("drift").get_drift(t=t, x=0, conditions=condition) for t in t_domain]
+                      for condition in conditions], dtype=float)
+    bound = np.array([[model.get_dependence("bound").get_bound(t=t, conditions=condition) for t in t_domain]
+                      for condition in conditions], dtype=float)
+    noise = np.array([[model.get_dependence("noise").get_noise(t=t, x=0, conditions=condition) for t in t_domain]
+                      for condition in conditions], dtype=float)
+    return drift, bound, noise
+
+
+def sample_IC(model, condition, n, rng):
+    x_domain = model.x_domain(conditions=condition)
+    IC = model.get_dependence("IC").get_IC(x_domain, dx=model.dx, conditions=condition)
+    return rng.choice(x_domain, size=n, p=IC / IC.sum())
+
+
+def sample_non_decision_time(model, n, rng):
+    overlay = model.get_dependence("overlay")
+    if isinstance(overlay, models.OverlayNonDecisionGaussian):
+        return rng.normal(loc=float(overlay.ndt_location), scale=float(overlay.ndt_scale), size=n)
+    elif isinstance(overlay, pyddm.OverlayNonDecisionUniform):
+        return rng.uniform(float(overlay.nondectime) - float(overlay.halfwidth),
+                           float(overlay.nondectime) + float(overlay.halfwidth), size=n)
+    elif isinstance(overlay, pyddm.OverlayNone):
+        return np.zeros(n)
+    else:
+        raise NotImplementedError("Overlay %s is not supported by the simulator" % type(overlay).__name__)
+
+
+def simulate_decisions(model, conditions, condition_idx, drift, bound, noise, rng):
+    """ Simulates one trial per entry of condition_idx (indices into conditions), given the (condition x time) drift,
+    bound, and noise. Returns the decision times (NaN if no bound was crossed before T_dur) and whether the upper (Go)
+    bound was crossed (False for undecided trials) """
+    dt = model.dt
+    n_trials = len(condition_idx)
+
+    x = np.empty(n_trials)
+    for i, condition in enumerate(conditions):
+        is_condition = condition_idx == i
+        x[is_condition] = sample_IC(model, condition, is_condition.sum(), rng)
+
+    decision_time = np.full(n_trials, np.nan)
+    is_upper = np.zeros(n_trials, dtype=bool)
+    # only the trials that have not crossed a bound yet are carried along
+    active = np.arange(n_trials)
+    x_active, idx_active = x, condition_idx
+    for i_t in range(drift.shape[1] - 1):
+        x_prev = x_active
+        variance = noise[idx_active, i_t] ** 2 * dt
+        x_active = x_prev + drift[idx_active, i_t] * dt + np.sqrt(variance) * rng.standard_normal(len(active))
+        bound_next = bound[idx_active, i_t + 1]
+        # a path can cross a bound and return within one timestep; without accounting for this the decisions are
+        # biased towards later times. The crossing probabilities of the Brownian bridge between x_prev and x_active
+        # are exp(-2 * (B - x_prev) * (B - x_active) / (noise**2 * dt)) for the upper bound, and mirrored for the lower
+        distance_upper = np.maximum(bound_next - x_prev, 0) * np.maximum(bound_next - x_active, 0)
+        distance_lower = np.maximum(bound_next + x_prev, 0) * np.maximum(bound_next + x_active, 0)
+        p_upper = np.exp(-2 * distance_upper / variance)
+        p_lower = np.exp(-2 * distance_lower / variance)
+        u = rng.random(len(active))
+        crossed = u < p_upper + p_lower
+        if crossed.any():
+            decision_time[active[crossed]] = (i_t + 1) * dt
+            is_upper[active[crossed]] = (u < p_upper)[crossed]
+            active, x_active, idx_active = active[~crossed], x_active[~crossed], idx_active[~crossed]
+            if len(active) == 0:
+                break
+    return decision_time, is_upper
+
+
+def simulate_trials(model, conditions, n_trials, seed=None, chunk_size=100000, subj_id="sim"):
+    """ Generator of DataFrames with n_trials simulated trials per condition, in chunks of at most chunk_size trials
+    so that memory use does not grow with n_trials. The output is reproducible for a given seed and chunk_size.
+
+    Each chunk has the index and columns of data/measures.csv: route is the index of the condition in conditions,
+    intersection_no is the trial number within the condition, and the measures that only exist for real trajectories
+    (e.g., min_distance) are NaN. As in 00_preprocess_data.py, RT is NaN when a response is missing, which here
+    means no bound was crossed before T_dur or the non-decision time made the RT non-positive. Trials in which no
+    bound was crossed have no choice: is_go_decision is NaN and decision is "Undecided", so that the proportions of
+    Go and Stay trials with an RT of at most T_dur estimate model.solve().prob("Go") and prob("Stay") """
+    # every chunk gets its own independent stream, so chunks can also be generated on their own
+    chunk_seeds = iter(np.random.SeedSequence(seed).spawn(int(np.ceil(n_trials * len(conditions) / chunk_size))))
+    drift, bound, noise = get_drift_bound_noise(model, conditions)
+    trials = np.arange(n_trials * len(conditions))
+    for chunk_start in range(0, len(trials), chunk_size):
+        rng = np.random.default_rng(next(chunk_seeds))
+        chunk = trials[chunk_start:chunk_start + chunk_size]
+        condition_idx, trial_no = chunk // n_trials, chunk % n_trials
+        decision_time, is_upper = simulate_decisions(model, conditions, condition_idx, drift, bound, noise, rng)
+        is_decided = ~np.isnan(decision_time)
+        RT = decision_time + sample_non_decision_time(model, len(chunk), rng)
+        RT[RT <= 0] = np.nan
+
+        chunk_conditions = pd.DataFrame([conditions[i] for i in condition_idx])
+        measures = pd.DataFrame({"subj_id": subj_id, "session": 1, "route": condition_idx,
+                                 "intersection_no": trial_no})
+        for column in ["idx_bot_visible", "idx_response", "idx_yield", "idx_min_distance", "min_distance",
+                       "gap_to_truck"]:
+            measures[column] = np.nan
+        measures["RT_gas"] = np.where(is_upper, RT, -1)
+        measures["RT_yield"] = np.where(is_decided & ~is_upper, RT, -1)
+        measures["is_negative_rating"] = False
+        measures["is_go_decision"] = np.where(is_decided, is_upper, np.nan)
+        for column in ["tta_0", "d_0", "a_values", "a_duration"]:
+            measures[column] = chunk_conditions[column].values
+        measures["decision"] = np.select([is_upper, is_decided], ["Go", "Stay"], "Undecided")
+        measures["RT"] = RT
+        yield measures.set_index(MEASURES_INDEX)[MEASURES_COLUMNS]
+
+
+def simulate_measures(model, conditions, n_trials, seed=None, chunk_size=100000, subj_id="sim"):
+    return pd.concat(simulate_trials(model, conditions, n_trials, seed=seed, chunk_size=chunk_size, subj_id=subj_id))
+
+
+def write_simulated_measures(file_name, model, conditions, n_trials, seed=None, chunk_size=100000, subj_id="sim"):
+    # writes the chunks one by one, so that millions of trials can be simulated without keeping them in memory
+    for i, measures in enumerate(simulate_trials(model, conditions, n_trials, seed=seed, chunk_size=chunk_size,
+                                                 subj_id=subj_id)):
+        measures.to_csv(file_name, index=True, mode="w" if i == 0 else "a", header=(i == 0))
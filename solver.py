@@ -0,0 +1,329 @@
+"""
+solver.py
+Batched implicit (backward Euler) Fokker-Planck solver for the models built by models.get_model.
+Instead of solving each condition separately, all conditions are advanced together: at every timestep the
+(condition x space) grids are stacked into one block-diagonal tridiagonal system and solved with a single
+LAPACK call. The discretization follows pyddm's implicit solver, which is what Model.solve uses for our models
+"""
+
+import collections
+import numpy as np
+import scipy.linalg
+import pyddm
+import models
+import profiling
+
+
+def can_solve_batched(model):
+    drift = model.get_dependence("drift")
+    bound = model.get_dependence("bound")
+    if not (hasattr(drift, "get_drift_from_states") and isinstance(drift.state_interpolators, models.StateTable)):
+        return False
+    if not (isinstance(bound, pyddm.BoundConstant) or
+            (hasattr(bound, "get_bound_from_states") and isinstance(bound.state_interpolators, models.StateTable))):
+        return False
+    state_table = drift.state_interpolators
+    return (isinstance(model.get_dependence("noise"), pyddm.NoiseConstant)
+            and np.isclose(state_table.dt, model.dt) and (len(state_table.t_domain) == len(model.t_domain())))
+
+
+@profiling.timer("drift_bound")
+def get_drift_and_bound(model, conditions):
+    # (condition x time) arrays of drift and bound evaluated from the state table
+    drift = model.get_dependence("drift")
+    bound = model.get_dependence("bound")
+    state_table = drift.state_interpolators
+    states = state_table.states[:, [state_table.get_condition_id(condition) for condition in conditions]]
+
+    drift_values = np.broadcast_to(drift.get_drift_from_states(*states), states.shape[1:])
+    if isinstance(bound, pyddm.BoundConstant):
+        bound_values = np.full(states.shape[1:], float(bound.B))
+    else:
+        bound_states = bound.state_interpolators.states[:, [bound.state_interpolators.get_condition_id(condition)
+                                                            for condition in conditions]]
+        bound_values = np.broadcast_to(bound.get_bound_from_states(*bound_states), states.shape[1:])
+    return np.asarray(drift_values, dtype=float), np.asarray(bound_values, dtype=float)
+
+
+def solve_batched(model, conditions):
+    """ Solutions of all conditions before the non-decision time is applied, as a list in the order of conditions.
+    pyddm's solver behaves differently in regimes that are not reproduced here: while the bound is below dx, while it
+    is below 3 dx with a drift so large that the implicit system is not diagonally dominant, and when the initial
+    condition lies outside of the bound at t=0 (which pyddm never counts as decided). The solutions of conditions that
+    reach them are None, to be solved with pyddm instead """
+    dt, dx = model.dt, model.dx
+    noise = float(model.get_dependence("noise").noise)
+    drift, bound = get_drift_and_bound(model, conditions)
+    n_conditions, n_t = drift.shape
+
+    # x domain of each condition as in pyddm.Model.x_domain: from -B to B, where B is the maximum bound over time
+    # aligned to dx. All domains are centered in a common grid of size n_x, padded with zeros
+    bound_max = bound.max(axis=1)
+    x_domains = [np.arange(-B, B + 0.1 * dx, dx) for B in np.ceil(bound_max / dx) * dx]
+    n_x = max(len(x_domain) for x_domain in x_domains)
+    offsets = np.array([(n_x - len(x_domain)) // 2 for x_domain in x_domains])
+
+    pdf_curr = np.zeros((n_conditions, n_x))
+    is_IC_outside = np.zeros(n_conditions, dtype=bool)
+    for i, (condition, x_domain) in enumerate(zip(conditions, x_domains)):
+        IC = model.get_dependence("IC").get_IC(x_domain, dx=dx, conditions=condition)
+        pdf_curr[i, offsets[i]:offsets[i] + len(x_domain)] = IC
+        is_IC_outside[i] = np.any(IC[np.abs(x_domain) > bound[i, 0]] > 0)
+    # the (collapsing) bound is approximated by the two grid points sandwiching it, weighted linearly
+    bound_shift = bound_max[:, None] - bound
+    x_index_outer = np.floor(bound_shift / dx).astype(int)
+    x_index_inner = np.ceil(bound_shift / dx).astype(int)
+    weight_inner = (bound_shift - x_index_outer * dx) / dx
+    weight_outer = 1. - weight_inner
+
+    # flux across the boundary at x is 0.5*dt/dx*sign(x)*drift + 0.5*dt/dx**2*noise**2. The upper boundary points
+    # of the outer and inner grid are at x = B - index*dx, and the lower ones are at the mirrored positions
+    noise_term = noise ** 2 * dt / dx ** 2
+    drift_term = 0.5 * dt / dx * drift
+    bound_grid = (np.ceil(bound_max / dx) * dx)[:, None]
+    sign_outer = np.sign(bound_grid - x_index_outer * dx)
+    sign_inner = np.sign(bound_grid - x_index_inner * dx)
+
+    # everything the time loop needs, as (time x ...) arrays so that each step reads contiguous rows
+    shifts_outer = (offsets[:, None] + x_index_outer).T
+    shifts_inner = (offsets[:, None] + x_index_inner).T
+    solve_inner = np.any(shifts_inner != shifts_outer, axis=1)
+    # off-diagonals of the matrix I + drift_matrix + noise_matrix of pyddm's implicit method, for the outer and the
+    # inner system. The diagonal is 1 + noise_term, except for the two outermost points at each end which also get
+    # the lower (first point) and upper (last point) couplings that are dropped from the off-diagonals
+    upper_values = np.tile(drift_term - 0.5 * noise_term, (2, 1)).T
+    lower_values = np.tile(-drift_term - 0.5 * noise_term, (2, 1)).T
+    # flat indices of the upper and lower boundary points of the outer and inner solution in the stacked system
+    rows = np.arange(n_conditions)
+    inner_rows = np.where(solve_inner[:, None], rows + n_conditions, rows)
+    boundary_idx = np.concatenate([rows * n_x + n_x - 1 - shifts_outer, rows * n_x + shifts_outer,
+                                   inner_rows * n_x + n_x - 1 - np.minimum(shifts_inner, n_x - 1),
+                                   inner_rows * n_x + np.minimum(shifts_inner, n_x - 1)], axis=1)
+    boundary_values = np.zeros((n_t, 4 * n_conditions))
+    mass_upper = np.zeros((n_t, n_conditions))
+    mass_lower = np.zeros((n_t, n_conditions))
+    is_running = np.zeros((n_t, n_conditions), dtype=bool)
+
+    running = np.ones(n_conditions, dtype=bool)
+    support_start = offsets
+    structure_key, structure = None, None
+    grid = np.arange(n_x)
+    for i_t in range(n_t - 1):
+        # for efficiency only diffuse while some density remains in the channel; as in pyddm's C solver, only the
+        # density within the (outer) bound counts
+        inside = (grid >= shifts_outer[i_t, :, None]) & (grid < n_x - shifts_outer[i_t, :, None])
+        running &= (pdf_curr * inside).sum(axis=1) >= 0.0001
+        if not running.any():
+            break
+        is_running[i_t + 1] = running
+
+        # global grid indices at which the outer and the inner system start
+        shift_outer, shift_inner = shifts_outer[i_t], shifts_inner[i_t]
+        shifts = np.concatenate([shift_outer, shift_inner]) if solve_inner[i_t] else shift_outer
+        n_blocks = len(shifts)
+        if structure_key is None or not np.array_equal(shifts, structure_key):
+            structure_key, structure = shifts, get_system_structure(shifts, n_x, noise_term)
+        in_bounds, upper_mask, lower_mask, diag_base, first_idx, last_idx, has_points = structure
+
+        diag = diag_base.copy()
+        diag.flat[first_idx] += lower_values[i_t, :n_blocks][has_points]
+        diag.flat[last_idx] += upper_values[i_t, :n_blocks][has_points]
+        upper = upper_mask * upper_values[i_t, :n_blocks, None]
+        lower = lower_mask * lower_values[i_t, :n_blocks, None]
+        rhs = np.empty((n_blocks, n_x))
+        rhs[:n_conditions] = pdf_curr
+        rhs[n_conditions:] = pdf_curr[:n_blocks - n_conditions]
+        rhs *= in_bounds
+        pdf_solved = scipy.linalg.lapack.dgtsv(lower.ravel()[:-1], diag.ravel(), upper.ravel()[:-1], rhs.ravel(),
+                                               overwrite_dl=True, overwrite_d=True, overwrite_du=True,
+                                               overwrite_b=True)[3]
+        boundary_values[i_t + 1] = pdf_solved[boundary_idx[i_t]]
+
+        # density that ended up outside of the (collapsed) bounds is considered a decision made
+        if np.any(shift_inner > support_start):
+            cumsum_prev = np.concatenate([np.zeros((n_conditions, 1)), np.cumsum(pdf_curr, axis=1)], axis=1)
+            mass_lower[i_t + 1] = (weight_outer[:, i_t] * cumsum_prev[rows, shift_outer]
+                                   + weight_inner[:, i_t] * cumsum_prev[rows, shift_inner])
+            mass_upper[i_t + 1] = (weight_outer[:, i_t] * (cumsum_prev[:, -1] - cumsum_prev[rows, n_x - shift_outer])
+                                   + weight_inner[:, i_t] * (cumsum_prev[:, -1] - cumsum_prev[rows, n_x - shift_inner]))
+
+        pdf_solved = pdf_solved.reshape(n_blocks, n_x)
+        if solve_inner[i_t]:
+            pdf_next = (weight_outer[:, i_t, None] * pdf_solved[:n_conditions]
+                        + weight_inner[:, i_t, None] * pdf_solved[n_conditions:])
+        else:
+            pdf_next = pdf_solved
+        if running.all():
+            pdf_curr = pdf_next
+            support_start = shift_outer
+        else:
+            pdf_curr[running] = pdf_next[running]
+            support_start = np.where(running, shift_outer, support_start)
+
+    # flux of the density at the boundary points of the outer and inner grid
+    sign_outer, sign_inner, weight_outer, weight_inner = sign_outer.T, sign_inner.T, weight_outer.T, weight_inner.T
+    drift_term = drift_term.T
+    inner_points = (shifts_inner < n_x - shifts_inner)
+    upper_outer, lower_outer, upper_inner, lower_inner = np.split(boundary_values, 4, axis=1)
+    # the flux at time i_t + 1 is determined by the drift and the bound at time i_t
+    pdf_choice_upper = np.zeros((n_t, n_conditions))
+    pdf_choice_lower = np.zeros((n_t, n_conditions))
+    pdf_choice_upper[1:] = (mass_upper[1:]
+                            + weight_outer[:-1] * upper_outer[1:] * (0.5 * noise_term + sign_outer * drift_term)[:-1]
+                            + (weight_inner * inner_points)[:-1] * upper_inner[1:]
+                            * (0.5 * noise_term + sign_inner * drift_term)[:-1])
+    pdf_choice_lower[1:] = (mass_lower[1:]
+                            + weight_outer[:-1] * lower_outer[1:] * (0.5 * noise_term - sign_outer * drift_term)[:-1]
+                            + (weight_inner * inner_points)[:-1] * lower_inner[1:]
+                            * (0.5 * noise_term - sign_inner * drift_term)[:-1])
+    pdf_choice_upper[1:] *= is_running[1:]
+    pdf_choice_lower[1:] *= is_running[1:]
+    pdf_choice_upper, pdf_choice_lower = pdf_choice_upper.T.copy(), pdf_choice_lower.T.copy()
+
+    # negative densities are numerical errors
+    pdf_choice_upper[pdf_choice_upper < 0] = 0
+    pdf_choice_lower[pdf_choice_lower < 0] = 0
+    pdf_curr[pdf_curr < 0] = 0
+
+    # the conditions that reach the regimes described above while running; the step from i_t to i_t + 1 uses the
+    # drift and the bound at i_t
+    is_not_dominant = 2 * np.abs(drift_term) > 1 + noise_term
+    is_left = (bound.T < dx) | (is_not_dominant & (bound.T < 3 * dx))
+    is_batched = ~np.any(is_running[1:] & is_left[:-1], axis=0) & ~is_IC_outside
+    return [pyddm.Solution(pdf_choice_upper[i], pdf_choice_lower[i], model, conditions=condition,
+                           pdf_undec=pdf_curr[i, offsets[i]:offsets[i] + len(x_domains[i])])
+            if is_batched[i] else None for i, condition in enumerate(conditions)]
+
+
+def solve_all_conditions(model, conditions):
+    """ Drop-in replacement for pyddm.solve_all_conditions(model, condition_combinations=conditions):
+    returns a dict of pyddm.Solution objects indexed by frozenset(condition.items()) """
+    return get_solutions(model, conditions, solve_batched(model, conditions))
+
+
+def apply_overlay_all(model, solutions):
+    overlay = model.get_dependence("overlay")
+    # e.g. when all conditions are left to pyddm
+    if len(solutions) == 0:
+        return []
+    if hasattr(overlay, "apply_all"):
+        return overlay.apply_all(solutions)
+    return [overlay.apply(solution) for solution in solutions]
+
+
+def get_solutions(model, conditions, solutions):
+    # the solutions of solve_batched with the overlay applied, where those that are None are solved with pyddm
+    overlaid = iter(apply_overlay_all(model, [solution for solution in solutions if solution is not None]))
+    return {frozenset(condition.items()): next(overlaid) if solution is not None else model.solve(conditions=condition)
+            for condition, solution in zip(conditions, solutions)}
+
+
+def get_solution_key(model, condition):
+    # everything the solution before the overlay depends on. The states are fully determined by the condition,
+    # T_dur and dt, so the state table itself is not part of the key
+    dependences = tuple((type(dependence).__name__,
+                         tuple(float(getattr(dependence, name)) for name in dependence.required_parameters
+                               if name != "state_interpolators"))
+                        for dependence in [model.get_dependence(name) for name in ["drift", "noise", "bound", "IC"]])
+    return dependences, model.dt, model.dx, model.T_dur, models.get_condition_key(condition)
+
+
+class SolutionCache:
+    """ LRU cache of solutions before the overlay is applied, indexed by the drift, noise, bound and IC parameters
+    and the condition. During fitting, parameter vectors that only differ in the overlay (non-decision time)
+    parameters, or that are evaluated repeatedly, are then solved only once. Only the solutions of solve_batched are
+    cached; the conditions it leaves to pyddm are solved again on every call. Entries are evicted, least recently
+    used first, when the cached arrays exceed max_bytes """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "SolutionCache(%s)" % ", ".join("%s=%s" % item for item in self.get_stats().items())
+
+    def get_stats(self):
+        n_requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / n_requests if n_requests > 0 else 0.,
+                "evictions": self.evictions, "entries": len(self.entries), "bytes": self.n_bytes}
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def add(self, key, solution):
+        arrays = (solution.choice_upper.copy(), solution.choice_lower.copy(), solution.undec.copy())
+        if key in self.entries:
+            self.n_bytes -= sum(array.nbytes for array in self.entries.pop(key))
+        self.entries[key] = arrays
+        self.n_bytes += sum(array.nbytes for array in arrays)
+        while self.n_bytes > self.max_bytes and self.entries:
+            self.n_bytes -= sum(array.nbytes for array in self.entries.popitem(last=False)[1])
+            self.evictions += 1
+
+    def solve_all_conditions(self, model, conditions):
+        keys = [get_solution_key(model, condition) for condition in conditions]
+        missing = [condition for condition, key in zip(conditions, keys) if key not in self.entries]
+        self.misses += len(missing)
+        self.hits += len(conditions) - len(missing)
+        unsolved = set()
+        if missing:
+            for condition, solution in zip(missing, solve_batched(model, missing)):
+                if solution is None:
+                    unsolved.add(get_solution_key(model, condition))
+                else:
+                    self.add(get_solution_key(model, condition), solution)
+
+        solutions = []
+        for condition, key in zip(conditions, keys):
+            if key in unsolved:
+                solutions.append(None)
+                continue
+            self.entries.move_to_end(key)
+            # pyddm.Solution may rescale the densities in place, so it gets copies of the cached arrays
+            choice_upper, choice_lower, undec = self.entries[key]
+            solutions.append(pyddm.Solution(choice_upper.copy(), choice_lower.copy(), model, conditions=condition,
+                                            pdf_undec=undec.copy()))
+        return get_solutions(model, conditions, solutions)
+
+
+# shared by the loss functions in loss_functions.py; set to None to disable caching
+solution_cache = SolutionCache()
+
+
+@profiling.timer("solver")
+def solve_sample(model, sample, method=None, conditions=None):
+    """ Solves the model for all condition combinations in the sample, using the batched solver (and the solution
+    cache) whenever the model supports it and falling back to pyddm otherwise. Finding the condition combinations
+    takes a pass over all trials, so callers that already know them (e.g. from their setup) can pass them """
+    if conditions is None:
+        conditions = sample.condition_combinations(required_conditions=model.required_conditions)
+    if method is None and can_solve_batched(model):
+        if solution_cache is not None:
+            return solution_cache.solve_all_conditions(model, conditions)
+        return solve_all_conditions(model, conditions)
+    return pyddm.functions.solve_all_conditions(model, condition_combinations=conditions, method=method)
+
+def get_system_structure(shifts, n_x, noise_term):
+    # Sparsity pattern of the stacked tridiagonal system: block b covers grid points [shifts[b], n_x - shifts[b]),
+    # outside of which the rows are decoupled identity rows. As in pyddm's implicit method, the couplings between
+    # the two outermost grid points at each end are moved to the diagonal
+    grid = np.arange(n_x)
+    start = shifts[:, None]
+    end = n_x - shifts[:, None]
+    in_bounds = ((grid >= start) & (grid < end)).astype(float)
+    upper_mask = ((grid >= start) & (grid <= end - 3)).astype(float)
+    lower_mask = ((grid >= start + 1) & (grid <= end - 2)).astype(float)
+    diag_base = 1. + noise_term * in_bounds
+    # blocks whose bounds collapsed completely have no grid points left
+    has_points = shifts < n_x - shifts
+    blocks = np.arange(len(shifts))
+    first_idx = (blocks * n_x + shifts)[has_points]
+    last_idx = (blocks * n_x + n_x - 1 - shifts)[has_points]
+    return in_bounds, upper_mask, lower_mask, diag_base, first_idx, last_idx, has_points
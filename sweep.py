@@ -0,0 +1,117 @@
+"""
+sweep.py
+Parallel, resumable parameter sweeps: model predictions for every (parameter set x condition) combination.
+The sweep is split into units of one parameter set and a chunk of conditions. Units are solved in a process pool
+with the batched solver and each finished unit is written as a separate Parquet file to the output directory, so
+an interrupted sweep can be resumed by running it again with the same arguments
+"""
+
+import os
+import json
+import hashlib
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import models
+import solver
+
+SWEEP_SPEC_FILE = "sweep.json"
+
+
+def get_measures(model, solution):
+    # same measures as get_model_measures in 03_simulate_fitted_models.ipynb
+    mean_rt_go = np.sum(solution.pdf(choice="Go") * model.t_domain()) * model.dt / solution.prob(choice="Go")
+    mean_rt_stay = np.sum(solution.pdf(choice="Stay") * model.t_domain()) * model.dt / solution.prob(choice="Stay")
+    return solution.prob(choice="Go"), mean_rt_go, mean_rt_stay
+
+
+def solve_unit(model_no, param_set, conditions, T_dur, dt):
+    model = models.get_model(model_no, T_dur, dt=dt, conditions=conditions)
+    model.set_model_parameters([param_set[name] for name in model.get_model_parameter_names()])
+    if solver.can_solve_batched(model):
+        solutions = solver.solve_all_conditions(model, conditions)
+    else:
+        solutions = {frozenset(condition.items()): model.solve(condition) for condition in conditions}
+    measures = [get_measures(model, solutions[frozenset(condition.items())]) for condition in conditions]
+
+    result = pd.DataFrame({"tta_0": [condition["tta_0"] for condition in conditions],
+                           "d_0": [condition["d_0"] for condition in conditions],
+                           # stored as in the csv files, e.g. "(0.0, -4.0, 4.0, 0.0)"
+                           "a_values": [str(tuple(condition["a_values"])) for condition in conditions],
+                           "a_duration": [condition["a_duration"] for condition in conditions]})
+    result[["is_go_decision", "RT_go", "RT_stay"]] = np.array(measures, dtype=float).reshape(-1, 3)
+    result["subj_id"] = str(param_set["subj_id"]) if "subj_id" in param_set else ""
+    return result
+
+
+def get_unit_file(output_dir, param_idx, chunk_idx):
+    return os.path.join(output_dir, "part_%06i_%06i.parquet" % (param_idx, chunk_idx))
+
+
+def write_unit(output_dir, param_idx, chunk_idx, result):
+    # write to a temporary file first so that an interrupted write never looks like a finished unit
+    file_name = get_unit_file(output_dir, param_idx, chunk_idx)
+    result.insert(0, "param_idx", param_idx)
+    result.to_parquet(file_name + ".tmp", index=False)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def check_sweep_spec(output_dir, spec):
+    # a sweep can only be resumed with the same model, parameters, conditions, and chunking
+    spec_file = os.path.join(output_dir, SWEEP_SPEC_FILE)
+    spec_hash = hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+    if os.path.exists(spec_file):
+        with open(spec_file) as f:
+            if json.load(f)["hash"] != spec_hash:
+                raise ValueError("%s contains results of a different sweep" % output_dir)
+    else:
+        with open(spec_file, "w") as f:
+            json.dump({"hash": spec_hash, "model_no": spec["model_no"], "T_dur": spec["T_dur"], "dt": spec["dt"],
+                       "n_parameter_sets": len(spec["parameters"]), "n_conditions": len(spec["conditions"])}, f)
+
+
+def run_sweep(model_no, parameters, conditions, output_dir, T_dur, dt=0.005, n_jobs=None, chunk_size=200,
+              verbose=True):
+    """ Solves the model for each row of the parameters DataFrame (columns named as in
+    model.get_model_parameter_names(), plus optionally subj_id) in each of the conditions.
+    Units that already exist in output_dir are skipped. n_jobs=1 runs in the current process,
+    n_jobs=None uses all CPUs. Returns the results, see read_sweep """
+    os.makedirs(output_dir, exist_ok=True)
+    parameters = parameters.reset_index(drop=True)
+    conditions = [dict(condition, a_values=tuple(condition["a_values"])) for condition in conditions]
+    check_sweep_spec(output_dir, {"model_no": model_no, "T_dur": T_dur, "dt": dt, "chunk_size": chunk_size,
+                                  "parameters": parameters.to_dict(orient="records"),
+                                  "conditions": [models.get_condition_key(condition) for condition in conditions]})
+
+    chunks = [conditions[i:i + chunk_size] for i in range(0, len(conditions), chunk_size)]
+    # chunk-major order, so that consecutive units reuse the cached model and state table of a chunk
+    units = [(param_idx, chunk_idx) for chunk_idx in range(len(chunks)) for param_idx in range(len(parameters))
+             if not os.path.exists(get_unit_file(output_dir, param_idx, chunk_idx))]
+    if verbose:
+        print("%i of %i units left" % (len(units), len(parameters) * len(chunks)))
+
+    if n_jobs == 1:
+        for i, (param_idx, chunk_idx) in enumerate(units):
+            result = solve_unit(model_no, parameters.iloc[param_idx], chunks[chunk_idx], T_dur, dt)
+            write_unit(output_dir, param_idx, chunk_idx, result)
+            if verbose:
+                print("%i/%i units done" % (i + 1, len(units)))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(solve_unit, model_no, parameters.iloc[param_idx], chunks[chunk_idx],
+                                       T_dur, dt): (param_idx, chunk_idx)
+                       for param_idx, chunk_idx in units}
+            # results are written as soon as they are ready, in whatever order the workers finish
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                param_idx, chunk_idx = futures[future]
+                write_unit(output_dir, param_idx, chunk_idx, future.result())
+                if verbose:
+                    print("%i/%i units done" % (i + 1, len(units)))
+
+    return read_sweep(output_dir)
+
+
+def read_sweep(output_dir):
+    # results ordered by parameter set, then by condition as passed to run_sweep
+    files = sorted(file for file in os.listdir(output_dir) if file.endswith(".parquet"))
+    return pd.concat([pd.read_parquet(os.path.join(output_dir, file)) for file in files], ignore_index=True)
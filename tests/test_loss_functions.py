@@ -0,0 +1,39 @@
+import numpy as np
+import pyddm
+import pytest
+import benchmarks
+import loss_functions
+import models
+import solver
+
+
+def get_losses(model_no):
+    model = models.get_model(model_no, T_dur=4)
+    model.set_model_parameters(models.get_nested_parameters(model, benchmarks.SYNTHETIC_PARAMETERS))
+    sample = pyddm.Sample.from_pandas_dataframe(df=benchmarks.get_synthetic_measures(100), rt_column_name="RT",
+                                                choice_column_name="is_go_decision", choice_names=("Go", "Stay"))
+    return model, [loss(sample, required_conditions=model.required_conditions, T_dur=model.T_dur, dt=model.dt,
+                        method=None, nparams=len(model.get_model_parameters()), samplesize=len(sample))
+                   for loss in [loss_functions.LossRobustBIC, loss_functions.LossRobustBICBinned]]
+
+
+@pytest.mark.parametrize("model_no", [2, 8])
+def test_binned_loss(model_no):
+    model, (loss, loss_binned) = get_losses(model_no)
+    assert loss_binned.loss(model) == pytest.approx(loss.loss(model), rel=1e-12)
+
+
+def test_binned_loss_negative_density(monkeypatch):
+    # negative densities, e.g. of extreme parameters, give an infinite loss, as in pyddm
+    model, (loss, loss_binned) = get_losses(2)
+    solve_sample = solver.solve_sample
+
+    def solve_sample_negative(*args, **kwargs):
+        solutions = solve_sample(*args, **kwargs)
+        for solution in solutions.values():
+            solution.choice_upper *= -1
+        return solutions
+
+    monkeypatch.setattr(solver, "solve_sample", solve_sample_negative)
+    assert loss.loss(model) == np.inf
+    assert loss_binned.loss(model) == np.inf
@@ -0,0 +1,25 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import models
+import simulator
+
+
+@pytest.mark.parametrize("condition_no", [2, 9])
+def test_simulated_choice_probabilities(condition_no):
+    # the model 2 fit to all subjects, which leaves part of the trials of condition 9 undecided at T_dur
+    model = models.get_model(2, T_dur=4)
+    parameters = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "modeling", "fit_results_bic", "model_2",
+                                          "subj_all_parameters_fitted.csv")).iloc[0]
+    model.set_model_parameters([parameters[name] for name in model.get_model_parameter_names()])
+    condition = models.get_conditions()[condition_no]
+    n_trials = 20000
+    measures = simulator.simulate_measures(model, [condition], n_trials, seed=0)
+    solution = model.solve(conditions=condition)
+    # pyddm only counts the decisions with an RT between 0 and T_dur
+    has_RT = measures.RT <= model.T_dur
+    for decision in ["Go", "Stay"]:
+        prob = solution.prob(decision)
+        assert np.mean((measures.decision == decision) & has_RT) == pytest.approx(
+            prob, abs=4 * np.sqrt(prob * (1 - prob) / n_trials))
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import models
+import solver
+
+
+def assert_solutions_equal(model, conditions, atol=1e-9):
+    solutions = solver.solve_all_conditions(model, conditions)
+    for condition in conditions:
+        expected = model.solve(conditions=condition)
+        solution = solutions[frozenset(condition.items())]
+        np.testing.assert_allclose(solution.pdf("_top"), expected.pdf("_top"), rtol=0, atol=atol / model.dt)
+        np.testing.assert_allclose(solution.pdf("_bottom"), expected.pdf("_bottom"), rtol=0, atol=atol / model.dt)
+        assert solution.prob_undecided() == pytest.approx(expected.prob_undecided(), abs=atol)
+
+
+@pytest.mark.parametrize("model_no", range(1, 9))
+def test_solve_all_conditions_random_parameters(model_no):
+    # parameters drawn uniformly within the fitting ranges, which include bounds that collapse below dx
+    model = models.get_model(model_no, T_dur=4)
+    ranges = np.array([(parameter.minval, parameter.maxval) for parameter in model.get_model_parameters()])
+    rng = np.random.default_rng(model_no)
+    for i in range(4):
+        model.set_model_parameters(ranges[:, 0] + (ranges[:, 1] - ranges[:, 0]) * rng.random(len(ranges)))
+        assert_solutions_equal(model, models.get_conditions())
+
+
+def test_solve_all_conditions_collapsed_bound():
+    # the bound of most conditions collapses below dx before all density has been absorbed
+    model = models.get_model(3, T_dur=4)
+    parameters = dict(alpha=2.087, beta_d=0.559, theta=2.808, b_0=1.391, k=1.601, tta_crit=9.746, ndt_location=0.3,
+                      ndt_scale=0.1)
+    model.set_model_parameters([parameters[name] for name in model.get_model_parameter_names()])
+    assert_solutions_equal(model, models.get_conditions())
+
+
+def test_solution_cache_hit():
+    # half of the conditions are left to pyddm at these parameters; the cache is keyed without the overlay
+    # parameters, so the second call hits the cache for all conditions that the batched solver solves
+    model = models.get_model(3, T_dur=4)
+    parameters = dict(alpha=1.061, beta_d=0.543, theta=3.361, b_0=3.273, k=1.804, tta_crit=9.061, ndt_location=0.269,
+                      ndt_scale=0.313)
+    model.set_model_parameters([parameters[name] for name in model.get_model_parameter_names()])
+    conditions = models.get_conditions()
+    cache = solver.SolutionCache()
+    cache.solve_all_conditions(model, conditions)
+    n_cached = len(cache.entries)
+    assert 0 < n_cached < len(conditions)
+    parameters["ndt_location"] = 0.4
+    model.set_model_parameters([parameters[name] for name in model.get_model_parameter_names()])
+    solutions = cache.solve_all_conditions(model, conditions)
+    assert cache.hits == n_cached
+    for condition in conditions:
+        expected = model.solve(conditions=condition)
+        solution = solutions[frozenset(condition.items())]
+        np.testing.assert_allclose(solution.pdf("_top"), expected.pdf("_top"), rtol=0, atol=1e-9 / model.dt)
+        np.testing.assert_allclose(solution.pdf("_bottom"), expected.pdf("_bottom"), rtol=0, atol=1e-9 / model.dt)
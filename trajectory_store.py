@@ -0,0 +1,122 @@
+"""
+trajectory_store.py
+Random access to the processed trajectories of 00_preprocess_data.py by trial. The store is a directory of parts
+(one per subject and session, or per raw data file), each with a numpy file per numeric column and an index of its
+trials with their conditions and row ranges. The columns are memory-mapped, so that loading a few trials reads only
+their rows instead of parsing all of processed_data.csv, e.g.
+
+    store = TrajectoryStore("data/processed_data")
+    store.get_trial(subj_id=5, session=1, route=2, intersection_no=3)
+    store.get_trials(subj_id=5, tta_0=5.5, a_values=(0.0, -4, 4, 0.0), columns=["t", "ego_v"])
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import results_store
+
+TRIAL_INDEX = ["subj_id", "session", "route", "intersection_no"]
+# columns that are constant within a trial, stored in the trial index
+CONDITION_COLUMNS = ["tta_0", "d_0", "a_values"]
+
+
+def write_part(data, path, name):
+    """ Writes data (processed trajectories indexed by TRIAL_INDEX, with the samples of each trial in consecutive rows)
+    as the part name of the store in path, replacing an earlier version of it. Of the non-numeric columns, only those of
+    CONDITION_COLUMNS are stored """
+    codes, trials = data.index.factorize()
+    # codes are numbered in the order of first appearance, so they only decrease if a trial is split up
+    if np.any(np.diff(codes) < 0):
+        raise ValueError("The samples of each trial need to be in consecutive rows")
+    part_path = os.path.join(path, name)
+    shutil.rmtree(part_path, ignore_errors=True)
+    os.makedirs(part_path)
+
+    lengths = np.bincount(codes, minlength=len(trials))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    index = data[CONDITION_COLUMNS].iloc[starts].reset_index()
+    index["a_values"] = index.a_values.astype(str)
+    index["start"] = starts
+    index["stop"] = starts + lengths
+    index.to_csv(os.path.join(part_path, "trials.csv"), index=False)
+
+    columns = [column for column in data.columns
+               if column in CONDITION_COLUMNS or pd.api.types.is_numeric_dtype(data[column])]
+    for column in columns:
+        if column not in CONDITION_COLUMNS:
+            np.save(os.path.join(part_path, column + ".npy"), data[column].to_numpy())
+    with open(os.path.join(part_path, "columns.json"), "w") as file:
+        json.dump({"columns": columns}, file)
+
+
+def remove_parts(path, keep=()):
+    # removes the parts of the store in path, except those in keep
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name not in keep:
+                shutil.rmtree(os.path.join(path, name))
+
+
+class TrajectoryStore:
+    def __init__(self, path="data/processed_data"):
+        self.path = path
+        parts = sorted(os.listdir(path))
+        self.trials = pd.concat([pd.read_csv(os.path.join(path, part, "trials.csv")).assign(part=part)
+                                 for part in parts], ignore_index=True)
+        self.trials = self.trials.sort_values(TRIAL_INDEX, kind="stable", ignore_index=True)
+        # a text key per acceleration profile, to select trials with a_values given as a tuple or a string
+        self.a_values_keys = self.trials.a_values.map({a_values: results_store.get_a_values_key(a_values)
+                                                       for a_values in self.trials.a_values.unique()})
+        with open(os.path.join(path, parts[0], "columns.json")) as file:
+            self.columns = json.load(file)["columns"]
+        # memory-mapped columns of each part, opened when they are first needed
+        self.part_columns = {}
+
+    def __repr__(self):
+        return "TrajectoryStore(%s, %i trials)" % (self.path, len(self.trials))
+
+    def get_column(self, part, column):
+        if part not in self.part_columns:
+            self.part_columns[part] = {}
+        if column not in self.part_columns[part]:
+            self.part_columns[part][column] = np.load(os.path.join(self.path, part, column + ".npy"), mmap_mode="r")
+        return self.part_columns[part][column]
+
+    def select(self, **selection):
+        """ Trials (rows of self.trials) that match all of selection (column=value, None matches anything), with
+        columns of TRIAL_INDEX and CONDITION_COLUMNS """
+        mask = np.ones(len(self.trials), dtype=bool)
+        for column, value in selection.items():
+            if value is None:
+                continue
+            if column == "a_values":
+                mask &= (self.a_values_keys == results_store.get_a_values_key(value)).to_numpy()
+            else:
+                mask &= (self.trials[column] == value).to_numpy()
+        return self.trials[mask]
+
+    def get_trials(self, columns=None, **selection):
+        """ Samples of the trials that match selection (see select) as in processed_data.csv: indexed by
+        TRIAL_INDEX, with the given columns (all if None) """
+        columns = self.columns if columns is None else columns
+        trials = self.select(**selection)
+        lengths = (trials.stop - trials.start).to_numpy()
+        samples = {}
+        for column in columns:
+            if len(trials) == 0:
+                samples[column] = []
+            elif column in CONDITION_COLUMNS:
+                samples[column] = np.repeat(trials[column].to_numpy(), lengths)
+            else:
+                # only the rows of the selected trials are read from the memory-mapped files
+                samples[column] = np.concatenate([self.get_column(part, column)[start:stop] for part, start, stop
+                                                  in zip(trials.part, trials.start, trials.stop)])
+        index = pd.MultiIndex.from_arrays([np.repeat(trials[level].to_numpy(), lengths) for level in TRIAL_INDEX],
+                                          names=TRIAL_INDEX)
+        return pd.DataFrame(samples, index=index, columns=columns)
+
+    def get_trial(self, subj_id, session, route, intersection_no, columns=None):
+        return self.get_trials(columns=columns, subj_id=subj_id, session=session, route=route,
+                               intersection_no=intersection_no)
@@ -19,8 +19,9 @@ def get_nudge_condition_map():
 def get_derivative(t, x):
     # To be able to reasonably calculate derivatives at the end-points of the trajectories,
     # append three extra points before and after the actual trajectory, so we get N+6
-    # points instead of N
-    x = np.append(x[0] * np.ones(3), np.append(x, x[-1] * np.ones(3)))
+    # points instead of N. x can also be a 2-D array with one trajectory per row, all sampled at t
+    x = np.asarray(x)
+    x = np.concatenate([np.repeat(x[..., :1], 3, axis=-1), x, np.repeat(x[..., -1:], 3, axis=-1)], axis=-1)
 
     # Time vector is also artificially extended by equally spaced points
     # Use median timestep to add dummy points to the time vector
@@ -30,16 +31,16 @@ def get_derivative(t, x):
     # smooth noise-robust differentiators, see:
     # http://www.holoborodko.com/pavel/numerical-methods/ \
     # numerical-derivative/smooth-low-noise-differentiators/#noiserobust_2
-    v = (1 * (x[6:] - x[:-6]) / ((t[6:] - t[:-6]) / 6) +
-         4 * (x[5:-1] - x[1:-5]) / ((t[5:-1] - t[1:-5]) / 4) +
-         5 * (x[4:-2] - x[2:-4]) / ((t[4:-2] - t[2:-4]) / 2)) / 32
+    v = (1 * (x[..., 6:] - x[..., :-6]) / ((t[6:] - t[:-6]) / 6) +
+         4 * (x[..., 5:-1] - x[..., 1:-5]) / ((t[5:-1] - t[1:-5]) / 4) +
+         5 * (x[..., 4:-2] - x[..., 2:-4]) / ((t[4:-2] - t[2:-4]) / 2)) / 32
 
     return v
 
 
 def write_to_csv(directory, filename, array, write_mode="a"):
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    # exist_ok, as parallel fits may create the same directory at the same time
+    os.makedirs(directory, exist_ok=True)
     with open(os.path.join(directory, filename), write_mode, newline="") as csvfile:
         writer = csv.writer(csvfile, delimiter=",")
         writer.writerow(array)